@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+"""
+Pack activity detection driving the sweep rate and autosleep
+
+The slope of the mean cell voltage over the last sweeps tells whether the
+pack is charging, discharging or idle. Fast voltage or temperature changes
+bring the sweeps down to fastInterval, a steady charge or discharge keeps
+the normal interval and an idle pack backs off to slowInterval. Once the
+pack has been idle for quietPeriod seconds with nothing to balance, the
+boards are put to sleep through REG_IO_CTRL until the next sweep.
+
+usage: interval = bmsmm.activity.update(bmsmm)
+"""
+
+import logging
+import time
+from collections import deque
+
+import numpy as np
+
+IDLE = 'idle'
+CHARGING = 'charging'
+DISCHARGING = 'discharging'
+
+class PackActivity:
+
+    def __init__(self, fastInterval=5, interval=120, slowInterval=900, activeRate=2e-5, fastRate=2e-4,
+                 tempStep=2.0, window=600, quietPeriod=1800, clock=time.monotonic):
+        self.fastInterval = fastInterval    #seconds between sweeps while things move fast
+        self.interval = interval            #seconds between sweeps while charging or discharging
+        self.slowInterval = slowInterval    #longest seconds between sweeps once idle
+        self.activeRate = activeRate        #V/s per cell below which the pack is idle
+        self.fastRate = fastRate            #V/s per cell above which sweeps go to fastInterval
+        self.tempStep = tempStep            #degrees between sweeps that go to fastInterval
+        self.window = window                #seconds of sweeps the slope is fitted on
+        self.quietPeriod = quietPeriod      #idle seconds before the boards go to sleep, None never sleeps
+        self.clock = clock
+        self.samples = deque()              #(time, mean cell volt)
+        self.state = IDLE
+        self.rate = 0.0                     #V/s per cell
+        self.idleSince = None
+        self.lastTemp = None
+        self.nextInterval = interval
+
+    def slope(self):
+        #least squares dV/dt of the samples in the window
+        if len(self.samples) < 2:
+            return 0.0
+        t0 = self.samples[0][0]
+        n = len(self.samples)
+        meanT = sum(t - t0 for t, v in self.samples) / n
+        meanV = sum(v for t, v in self.samples) / n
+        var = sum((t - t0 - meanT) ** 2 for t, v in self.samples)
+        if var <= 0:
+            return 0.0
+        return sum((t - t0 - meanT) * (v - meanV) for t, v in self.samples) / var
+
+    def update(self, manager):
+        #call after every sweep, returns the seconds to wait before the next one
+        now = self.clock()
+        #only the modules read by this sweep, a failed read must not look like a voltage or temperature step
+        rows = manager.sweepRows
+        cells = manager.pack.cellVolt[rows]
+        temps = manager.pack.temperatures[rows]
+        temp = float(np.nanmax(temps)) if np.isfinite(temps).any() else None
+        if not np.isfinite(cells).any():
+            return self.interval
+        self.samples.append((now, float(np.nanmean(cells))))
+        while now - self.samples[0][0] > self.window:
+            self.samples.popleft()
+        self.rate = self.slope()
+
+        previous = self.state
+        if self.rate >= self.activeRate:
+            self.state = CHARGING
+        elif self.rate <= -self.activeRate:
+            self.state = DISCHARGING
+        else:
+            self.state = IDLE
+        if self.state != previous:
+            logging.debug('[!] Pack is now %s (%.1f mV/h per cell)' % (self.state, self.rate * 3.6e6))
+
+        tempChange = temp is not None and self.lastTemp is not None and abs(temp - self.lastTemp) >= self.tempStep
+        self.lastTemp = temp
+        if abs(self.rate) >= self.fastRate or tempChange:
+            self.nextInterval = self.fastInterval
+        elif self.state != IDLE:
+            self.nextInterval = self.interval
+        else:
+            #back off a little more every idle sweep
+            self.nextInterval = min(self.slowInterval, max(self.nextInterval, self.fastInterval) * 2)
+
+        if self.state != IDLE or tempChange:
+            self.idleSince = None
+        elif self.idleSince is None:
+            self.idleSince = now
+        if self.shouldSleep(manager, now):
+            manager.sleepBoards()
+        return self.nextInterval
+
+    def shouldSleep(self, manager, now):
+        if self.quietPeriod is None or self.idleSince is None or manager.asleep:
+            return False
+        if manager.isFaulted or manager.balancer.active():
+            return False
+        return now - self.idleSince >= self.quietPeriod
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+"""
+asyncio transport and control loop for the Tesla BMS modules
+
+AsyncComms speaks the same frames as BMSUtils.Comms but never blocks:
+requests go through an ordered queue, each one gets its own future and
+timeout, and the UART is read by the event loop. AsyncBMSModuleManager
+runs the shared BMSModuleManager on one worker thread with AsyncComms as
+its transport, so topology, write shadow, balancer and fault polling are
+the same as the synchronous manager while storage and a status API share
+the event loop.
+"""
+
+import asyncio
+import functools
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from BMSUtils import *
+from BMSCrc import genCRC, checkFrame
+from BMSModuleManager import BMSModuleManager, TOPOLOGY_FILE
+
+class SerialProtocol(asyncio.Protocol):
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.waiter = None
+        self.needed = 0
+
+    def data_received(self, data):
+        self.buffer += data
+        if self.waiter and not self.waiter.done() and len(self.buffer) >= self.needed:
+            self.waiter.set_result(None)
+
+    def connection_lost(self, exc):
+        if self.waiter and not self.waiter.done():
+            self.waiter.set_exception(exc or ConnectionError("serial port closed"))
+
+    async def receive(self, numBytes, timeout):
+        #wait for numBytes or the timeout, returns whatever arrived
+        if len(self.buffer) < numBytes:
+            self.needed = numBytes
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await asyncio.wait_for(self.waiter, timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self.waiter = None
+        data = bytes(self.buffer[:numBytes])
+        del self.buffer[:numBytes]
+        return data
+
+class AsyncComms:
+
+    def __init__(self, protocol, writer, frameTimeout=FRAME_TIMEOUT):
+        self.protocol = protocol
+        self.writer = writer
+        self.frameTimeout = frameTimeout
+        self.queue = asyncio.Queue()
+        self.worker = None
+        self.loop = None
+
+    @classmethod
+    async def open(cls, serPort, frameTimeout=FRAME_TIMEOUT):
+        #pyserial configures the port (612500 is not a standard termios rate), asyncio does the I/O
+        import serial
+        ser = serial.Serial(port=serPort, baudrate=612500, timeout=0)
+        loop = asyncio.get_running_loop()
+        protocol = SerialProtocol()
+        await loop.connect_read_pipe(lambda: protocol, os.fdopen(os.dup(ser.fileno()), 'rb', buffering=0))
+        writer, _ = await loop.connect_write_pipe(asyncio.BaseProtocol, os.fdopen(os.dup(ser.fileno()), 'wb', buffering=0))
+        comms = cls(protocol, writer, frameTimeout)
+        comms.ser = ser
+        comms.start()
+        return comms
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.worker = self.loop.create_task(self.__process())
+
+    async def close(self):
+        if self.worker:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+        self.writer.close()
+
+    async def __process(self):
+        #one transaction on the wire at a time, in the order they were queued
+        while True:
+            frame, rxLen, checkCRC, timeout, future = await self.queue.get()
+            if future.cancelled():
+                continue
+            self.protocol.buffer.clear() #drop stale bytes from a previous timed out frame
+            self.writer.write(frame)
+            try:
+                rxData = await self.protocol.receive(rxLen, timeout)
+            except ConnectionError as e:
+                future.set_exception(e)
+                continue
+            if future.cancelled():
+                continue
+            if not checkCRC:
+                future.set_result(list(rxData))
+            elif len(rxData) < rxLen:
+                logging.debug("RX TIMEOUT got %d of %d bytes" % (len(rxData), rxLen))
+                future.set_result(False)
+            elif not checkFrame(rxData):
+                logging.debug("CRC FAIL 0x%x, 0x%x" % (rxData[-1], genCRC(rxData[:-1])))
+                future.set_result(False)
+            else:
+                future.set_result(list(rxData))
+
+    def submit(self, write, moduleAddress, address, value, rxLen, checkCRC=True, timeout=None):
+        #queue a transaction, the returned future resolves to the reply or False
+        frame = bytearray([(moduleAddress << 1) | (1 if write else 0), address, value])
+        if write:
+            frame.append(genCRC(frame))
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((bytes(frame), rxLen, checkCRC, timeout or self.frameTimeout, future))
+        return future
+
+    async def transact(self, frame, rxLen, timeout=None):
+        #queue an already built frame, returns the raw reply bytes, short on timeout, see QueuedSerial
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((bytes(frame), rxLen, False, timeout or self.frameTimeout, future))
+        return bytes(await future)
+
+    def read(self, moduleAddress, address, numBytes, timeout=None):
+        return self.submit(False, moduleAddress, address, numBytes, numBytes + 4, timeout=timeout)
+
+    def readNoCRC(self, moduleAddress, address, numBytes, timeout=None):
+        return self.submit(False, moduleAddress, address, numBytes, numBytes + 4, False, timeout)
+
+    def write(self, moduleAddress, address, data, timeout=None):
+        return self.submit(True, moduleAddress, address, data, 4, timeout=timeout)
+
+class QueuedSerial:
+    #serial.Serial like object handed to BMSUtils.Comms on a worker thread, every frame goes through the AsyncComms queue
+
+    def __init__(self, comms):
+        self.comms = comms
+        self.timeout = comms.frameTimeout
+        self.frame = None
+        self.is_open = True
+
+    def write(self, data):
+        #held until Comms reads the reply, the read tells how long the reply is
+        self.frame = bytes(data)
+        return len(data)
+
+    def readinto(self, buffer):
+        if self.frame is None:
+            return 0
+        frame, self.frame = self.frame, None
+        data = asyncio.run_coroutine_threadsafe(self.comms.transact(frame, len(buffer), self.timeout), self.comms.loop).result()
+        buffer[:len(data)] = data
+        return len(data)
+
+    def read(self, size=1):
+        buffer = bytearray(size)
+        return bytes(buffer[:self.readinto(buffer)])
+
+    def reset_input_buffer(self):
+        #AsyncComms drops stale bytes before every frame
+        self.frame = None
+
+    def flush(self):
+        pass
+
+    def isOpen(self):
+        return self.is_open
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+class AsyncBMSModuleManager:
+
+    def __init__(self, comms, topologyFile=TOPOLOGY_FILE, name=None):
+        #comms is a started AsyncComms, name labels the metrics of the chain like BMSModuleManager
+        self.comms = comms
+        #one worker keeps the manager calls in order, the event loop only waits for them
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bms-async')
+        self.manager = BMSModuleManager(QueuedSerial(comms), topologyFile, name=name)
+        self.listeners = []     #coroutine functions called with the manager after every sweep
+
+    def __getattr__(self, name):
+        #modules, pack, packVolt, isFaulted, balancer... are the ones of the shared manager
+        if name == 'manager':
+            raise AttributeError(name)
+        return getattr(self.manager, name)
+
+    async def call(self, method, *args):
+        #run a method of the shared manager on the worker thread
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(getattr(self.manager, method), *args))
+
+    async def setup(self):
+        await self.call('connect')
+        return self
+
+    async def run(self, interval=None, commands=None, minStep=0.5, faultInterval=1.0, checkInterval=3600):
+        #BMSModuleManager.run turned from the event loop, listeners (storage, status API...) run between sweeps
+        if not self.manager.connected:
+            await self.setup()
+        due = {"sweep": time.monotonic(), "poll": time.monotonic() + faultInterval, "check": time.monotonic()}
+        while True:
+            lastSweep = due["sweep"]
+            wait = await self.call('tick', due, interval, commands, faultInterval, checkInterval)
+            if due["sweep"] != lastSweep:
+                for listener in self.listeners:
+                    await listener(self)
+            await asyncio.sleep(max(minStep, wait))
+
+    async def readAllVoltTemp(self):
+        return await self.call('readAllVoltTemp')
+
+    async def balanceCells(self, duration=5):
+        return await self.call('balanceCells', duration)
+
+    async def clearFaults(self):
+        return await self.call('clearFaults')
+
+    async def pollFaults(self):
+        return await self.call('pollFaults')
+
+    async def checkModules(self):
+        return await self.call('checkModules')
+
+    async def close(self):
+        self.executor.shutdown()
+        self.manager.close()
+        await self.comms.close()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+"""
+Balancing scheduler interleaved with the measurement sweeps
+
+Every module keeps its own balancing state: until when each of its cells
+should bleed, the duty cycle allowed by its temperature, the REG_BAL_CTRL
+mask that follows from them and what was last confirmed on the module.
+The manager calls step() from its main loop, each step only does the bus
+transactions that are due (re-arming the module timer, checking a module
+still bleeds, stopping an expired one) and returns, so nothing waits on
+the balance timers. A measurement sweep pauses the bleed resistors,
+converts, and resumes them right after.
+
+REG_BAL_TIME is only a watchdog: modules are armed for holdTime seconds
+and re-armed before it runs out, so they stop by themselves if the
+control loop dies.
+"""
+
+import logging
+import time
+
+from BMSUtils import *
+
+BALANCE_SETTLE = 0.02       #seconds for the cell voltages to recover once the bleed resistors are off
+CELLS_PER_MODULE = 6
+
+class ModuleBalance:
+
+    def __init__(self, moduleAddress):
+        self.moduleAddress = moduleAddress
+        self.cellExpiry = [0.0] * CELLS_PER_MODULE  #clock time each cell stops bleeding
+        self.duty = 1.0             #fraction of every cycle the resistors may be on, see BalancePlanner
+        self.cycle = 60.0           #seconds of one on/off duty cycle
+        self.cycleStart = 0.0
+        self.target = 0             #REG_BAL_CTRL mask to bleed
+        self.armedAt = None         #clock time REG_BAL_CTRL was last written, None when off on the module
+        self.verified = 0           #REG_BAL_CTRL last read back or acknowledged
+        self.verifiedAt = 0.0
+        self.bled = [0.0] * CELLS_PER_MODULE        #seconds each cell bled, see takeBled
+        self.onMask = 0
+        self.onSince = 0.0
+
+    def expiry(self):
+        return max(self.cellExpiry)
+
+    def wanted(self, now):
+        #mask the module should bleed at now
+        mask = 0
+        for i, expiry in enumerate(self.cellExpiry):
+            if expiry > now:
+                mask |= 1 << i
+        if mask and self.duty < 1.0 and (now - self.cycleStart) % self.cycle >= self.duty * self.cycle:
+            return 0
+        return mask
+
+    def nextChange(self, now):
+        #clock time wanted() may change
+        times = [expiry for expiry in self.cellExpiry if expiry > now]
+        if times and self.duty < 1.0:
+            phase = (now - self.cycleStart) % self.cycle
+            onTime = self.duty * self.cycle
+            times.append(now + (onTime - phase if phase < onTime else self.cycle - phase))
+        return min(times) if times else float('inf')
+
+    def account(self, now, mask):
+        #the resistors of mask are on from now, add the time of the previous ones to bled
+        for i in range(CELLS_PER_MODULE):
+            if self.onMask & (1 << i):
+                self.bled[i] += now - self.onSince
+        self.onMask = mask
+        self.onSince = now
+
+class BMSBalancer:
+
+    def __init__(self, manager, tolerance=0.05, holdTime=30, verifyInterval=10, clock=time.monotonic):
+        self.manager = manager
+        self.tolerance = tolerance              #V above the lowest cell before a cell gets bled
+        self.holdTime = min(holdTime, 0x3F)     #REG_BAL_TIME in seconds, re-armed at half of it
+        self.verifyInterval = verifyInterval    #seconds between REG_BAL_CTRL read backs
+        self.clock = clock
+        self.states = {}
+        self.paused = False
+
+    def state(self, module):
+        state = self.states.get(module.moduleAddress)
+        if state is None:
+            state = self.states[module.moduleAddress] = ModuleBalance(module.moduleAddress)
+        return state
+
+    def active(self):
+        now = self.clock()
+        return any(state.target or state.expiry() > now for state in self.states.values())
+
+    def plan(self, duration, tolerance=None):
+        #every cell more than tolerance above the lowest one bleeds for duration, the writes happen on the next step
+        now = self.clock()
+        tolerance = self.tolerance if tolerance is None else tolerance
+        masks = self.manager.pack.balanceMasks(tolerance)
+        for module, mask in zip(self.manager.modules, masks.tolist()):
+            if mask:
+                logging.debug('[!] Module %d balancing 0x%X for %ds', module.moduleAddress, mask, duration)
+            self.assign(module, [duration if mask & (1 << i) else 0.0 for i in range(CELLS_PER_MODULE)])
+
+    def assign(self, module, durations, duty=1.0):
+        #bleed each cell of module for its duration in seconds from now, on duty of the time, see BMSPlanner
+        state = self.state(module)
+        now = self.clock()
+        state.cellExpiry = [now + duration if duration > 0 else now for duration in durations]
+        if duty != state.duty:
+            state.cycleStart = now
+        state.duty = duty
+
+    def takeBled(self, module):
+        #seconds each cell of module bled since the last call
+        state = self.state(module)
+        state.account(self.clock(), state.onMask)
+        bled = state.bled
+        state.bled = [0.0] * CELLS_PER_MODULE
+        return bled
+
+    def step(self):
+        #run the transactions that are due, returns the clock time of the next one
+        if self.paused:
+            return self.nextStep()
+        now = self.clock()
+        comms = self.manager.comms
+        for state in self.states.values():
+            wanted = state.wanted(now)
+            if wanted != state.target:
+                if not wanted and not state.expiry() > now:
+                    logging.debug('[!] Module %d done balancing', state.moduleAddress)
+                state.target = wanted
+                if state.armedAt is not None:
+                    state.armedAt = 0.0
+            if not state.target:
+                if state.armedAt is not None:
+                    if comms.write(state.moduleAddress, REG_BAL_CTRL, 0x00):
+                        state.armedAt = None
+                        state.verified = 0
+                        state.account(now, 0)
+                continue
+            if state.armedAt is None or now - state.armedAt >= self.holdTime / 2:
+                self.__arm(state, now)
+            elif now - state.verifiedAt >= self.verifyInterval:
+                val = comms.read(state.moduleAddress, REG_BAL_CTRL, 1)
+                if val:
+                    state.verified = val[3]
+                    state.verifiedAt = now
+                    if state.verified != state.target:
+                        #the module was reset or its timer ran out
+                        logging.warning('[-] Module %d bleeds 0x%X instead of 0x%X, re-arming' % (state.moduleAddress, state.verified, state.target))
+                        self.__arm(state, now)
+        return self.nextStep()
+
+    def nextStep(self):
+        now = self.clock()
+        times = []
+        for state in self.states.values():
+            times.append(state.nextChange(now))
+            if state.target:
+                times.append(0.0 if state.armedAt is None else state.armedAt + self.holdTime / 2)
+                times.append(state.verifiedAt + self.verifyInterval)
+            elif state.armedAt is not None:
+                times.append(0.0)
+        return min(times) if times else float('inf')
+
+    def pause(self):
+        #bleed resistors off for a measurement window, returns True when they were on
+        self.paused = True
+        now = self.clock()
+        wasOn = any(state.armedAt is not None for state in self.states.values())
+        self.manager.comms.write(BROADCAST, REG_BAL_CTRL, 0x00)
+        for state in self.states.values():
+            if state.armedAt is not None:
+                state.armedAt = 0.0 if state.target else None
+            state.verified = 0
+            state.account(now, 0)
+        return wasOn
+
+    def resume(self):
+        self.paused = False
+        self.step()
+
+    def stop(self):
+        now = self.clock()
+        for state in self.states.values():
+            state.cellExpiry = [0.0] * CELLS_PER_MODULE
+            state.target = 0
+            state.armedAt = None
+            state.verified = 0
+            state.account(now, 0)
+        self.manager.comms.write(BROADCAST, REG_BAL_CTRL, 0x00)
+
+    def __arm(self, state, now):
+        comms = self.manager.comms
+        if comms.write(state.moduleAddress, REG_BAL_TIME, self.holdTime) and comms.write(state.moduleAddress, REG_BAL_CTRL, state.target):
+            state.armedAt = now
+            #the echo confirms the module took the mask
+            state.verified = state.target
+            state.verifiedAt = now
+            state.account(now, state.target)
+        else:
+            logging.warning('[-] Could not start balancing on module %d' % state.moduleAddress)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+"""
+Scan throughput benchmark against the simulated daisy chain
+
+Runs autoAssignModuleAddresses, readAllVoltTemp and balanceCells on chains
+of increasing size and reports for each operation the wall time, the CPU
+time spent in Python, the time left waiting on I/O, the number of bus
+transactions and the bytes on the wire. The simulator runs in the same
+process, its own CPU time is reported apart and left out of the Python
+CPU time so only the manager side is measured. Results are written as
+JSON so runs from different versions can be compared.
+
+usage: BMSBenchmark.py [-o bench.json] [--sizes 1 8 16 32 62] [--sweeps 5] [--skip-balance]
+"""
+
+import argparse
+import json
+import logging
+import platform
+import subprocess
+import time
+
+from BMSSimulator import SimulatedChain
+from BMSModuleManager import BMSModuleManager
+
+CHAIN_SIZES = (1, 8, 16, 32, 62)
+
+def measure(chain, fn, repeat=1):
+    transactions, txBytes, rxBytes = chain.transactions, chain.txBytes, chain.rxBytes
+    simulator = chain.cpu
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    for i in range(repeat):
+        fn()
+    wall = (time.perf_counter() - wall) / repeat
+    simulator = (chain.cpu - simulator) / repeat
+    #the simulator answers in the same process, its time would not be spent with a real chain
+    cpu = max(0.0, (time.process_time() - cpu) / repeat - simulator)
+    return {
+        "wall": wall,
+        "cpu": cpu,
+        "simulatorCpu": simulator,
+        "ioWait": max(0.0, wall - cpu - simulator),
+        "transactions": (chain.transactions - transactions) / repeat,
+        "txBytes": (chain.txBytes - txBytes) / repeat,
+        "rxBytes": (chain.rxBytes - rxBytes) / repeat,
+    }
+
+def benchChain(numModules, sweeps=5, balance=True, realtime=True):
+    chain = SimulatedChain(numModules, realtime=realtime, seed=numModules)
+    #spread the cells a little so balancing has work to do
+    for n, module in enumerate(chain.modules):
+        module.cellVolt = [3.70 + 0.02 * ((n + i) % 5) for i in range(6)]
+
+    result = {"modules": numModules}
+    bmsmm = None
+
+    def setup():
+        nonlocal bmsmm
+        bmsmm = BMSModuleManager(chain, topologyFile=None).connect()
+    result["autoAssignModuleAddresses"] = measure(chain, setup)
+    result["found"] = len(bmsmm.modules)
+    result["readAllVoltTemp"] = measure(chain, bmsmm.readAllVoltTemp, sweeps)
+    if balance:
+        result["balanceCells"] = measure(chain, bmsmm.balanceCells)
+    result["writesSaved"] = bmsmm.comms.writesSaved
+    return result
+
+def version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pack sweeps against the simulated chain")
+    parser.add_argument("-o", "--output", default="bench.json", help="JSON result file")
+    parser.add_argument("--sizes", type=int, nargs="+", default=CHAIN_SIZES, help="chain sizes to run")
+    parser.add_argument("--sweeps", type=int, default=5, help="readAllVoltTemp sweeps to average")
+    parser.add_argument("--skip-balance", action="store_true", help="do not run balanceCells")
+    parser.add_argument("--no-realtime", action="store_true", help="do not simulate UART byte timing")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    results = []
+    for numModules in args.sizes:
+        result = benchChain(numModules, args.sweeps, not args.skip_balance, not args.no_realtime)
+        results.append(result)
+        sweep = result["readAllVoltTemp"]
+        print("%2d modules: sweep %8.2f ms (cpu %7.2f ms, simulator %7.2f ms, io %7.2f ms) %5d transactions %6d bytes" % (
+            numModules, sweep["wall"] * 1e3, sweep["cpu"] * 1e3, sweep["simulatorCpu"] * 1e3, sweep["ioWait"] * 1e3,
+            sweep["transactions"], sweep["txBytes"] + sweep["rxBytes"]))
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "version": version(),
+            "python": platform.python_version(),
+            "timestamp": time.time(),
+            "results": results,
+        }, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+"""
+Capture of the raw UART traffic, replay and offline analysis
+
+Comms.startCapture(path) appends every transaction to a binary file: the
+time the frame was sent and the time the reply ended (perf_counter seconds
+since the capture started), then the bytes sent and the bytes received,
+whatever they were. ReplaySerial plays a capture back as a serial port so
+BMSModuleManager runs on field traffic, paced like the recording or as
+fast as possible, reading the capture as it goes so days of traffic
+replay in constant memory. analyze() memory maps a capture and reports CRC
+failures, timeouts, latency and decoded cell voltages per module.
+
+usage: Comms('/dev/ttyUSB1').startCapture('field.bmscap')      before the manager so enumeration is recorded
+       bmsmm = BMSModuleManager('/dev/ttyUSB1', topologyFile=None)
+       bmsmm = BMSModuleManager(ReplaySerial('field.bmscap'), topologyFile=None)
+       BMSCapture.py field.bmscap
+"""
+
+import logging
+import mmap
+import struct
+import sys
+import time
+from collections import deque
+
+import numpy as np
+
+from BMSCrc import checkFrame
+from BMSConvert import cellVolts, moduleVolts, temperatures
+
+MAGIC = b'BMSCAP1\0'
+HEADER = struct.Struct('<8sd')      #magic, wall clock time of the capture start
+RECORD = struct.Struct('<ddBH')     #TX time, end of RX time, TX length, RX length, then the bytes
+ADC_BYTES = 18                      #ModuleV, 6 cells and 2 temperatures from REG_GPAI
+
+class Capture:
+
+    def __init__(self, path, flushInterval=1.0):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.start = time.perf_counter()
+        self.file.write(HEADER.pack(MAGIC, time.time()))
+        self.records = 0
+        self.flushInterval = flushInterval  #seconds of traffic a crash or power loss may lose at most
+        self.flushed = 0.0
+
+    def record(self, txTime, rxTime, tx, rx):
+        self.file.write(RECORD.pack(txTime - self.start, rxTime - self.start, len(tx), len(rx)))
+        self.file.write(tx)
+        self.file.write(rx)
+        self.records += 1
+        if rxTime - self.start - self.flushed >= self.flushInterval:
+            self.file.flush()
+            self.flushed = rxTime - self.start
+
+    def close(self):
+        self.file.close()
+
+class CaptureReader:
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.wallStart = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a capture' % path)
+
+    def __iter__(self):
+        #(txTime, rxTime, tx, rx) with tx and rx as memoryviews on the map, a truncated last record is dropped
+        view = memoryview(self.map)
+        offset = HEADER.size
+        size = len(self.map)
+        unpack = RECORD.unpack_from
+        while offset + RECORD.size <= size:
+            txTime, rxTime, txLen, rxLen = unpack(self.map, offset)
+            offset += RECORD.size
+            if offset + txLen + rxLen > size:
+                break
+            yield txTime, rxTime, view[offset:offset + txLen], view[offset + txLen:offset + txLen + rxLen]
+            offset += txLen + rxLen
+
+    def close(self):
+        self.map.close()
+
+class ReplaySerial:
+    #serial.Serial like object answering from a capture, hand it to BMSModuleManager in place of a port
+
+    def __init__(self, path, realtime=False, lookahead=64):
+        self.records = iter(CaptureReader(path))
+        self.pending = deque()              #the next records of the capture, at most lookahead of them
+        self.realtime = realtime            #pace the replies like the recording, else as fast as possible
+        self.lookahead = lookahead          #records searched for a frame matching what the code sent
+        self.rx = bytearray()
+        self.timeout = 0
+        self.is_open = True
+        self.start = None
+        self.skipped = 0                    #recorded transactions the code did not make
+        self.missed = 0                     #transactions the code made that were not recorded
+        self.transactions = 0
+
+    def fill(self):
+        #copy the records out of the map only as the replay gets to them
+        while len(self.pending) < self.lookahead:
+            record = next(self.records, None)
+            if record is None:
+                return
+            txTime, rxTime, tx, rx = record
+            self.pending.append((txTime, rxTime, bytes(tx), bytes(rx)))
+
+    def done(self):
+        self.fill()
+        return not self.pending
+
+    def write(self, data):
+        data = bytes(data)
+        self.fill()
+        for n, (txTime, rxTime, tx, rx) in enumerate(self.pending):
+            if tx == data:
+                break
+        else:
+            logging.debug('[-] Replay has no recorded reply to %s' % data.hex())
+            self.missed += 1
+            return len(data)
+        self.skipped += n
+        for i in range(n + 1):
+            self.pending.popleft()
+        self.transactions += 1
+        if self.realtime:
+            #line the replay clock up with the recording on the first frame, then keep its pace
+            if self.start is None:
+                self.start = time.perf_counter() - txTime
+            delay = self.start + rxTime - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        self.rx += rx
+        return len(data)
+
+    def read(self, size=1):
+        data = bytes(self.rx[:size])
+        del self.rx[:size]
+        if not data and self.timeout:
+            #nothing was recorded for this frame, a real chain would not answer either
+            time.sleep(self.timeout)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def inWaiting(self):
+        return len(self.rx)
+
+    @property
+    def in_waiting(self):
+        return len(self.rx)
+
+    def reset_input_buffer(self):
+        self.rx.clear()
+
+    def flush(self):
+        pass
+
+    def isOpen(self):
+        return self.is_open
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+def analyze(path):
+    #per module transaction counts, CRC failures, timeouts, latency and decoded ADC readings of a capture
+    reader = CaptureReader(path)
+    modules = {}
+    adc = []        #(time, module, 9 raw words)
+    first = last = None
+    for txTime, rxTime, tx, rx in reader:
+        if first is None:
+            first = txTime
+        last = rxTime
+        address = tx[0] >> 1
+        write = tx[0] & 0x01
+        expected = 4 if write else tx[2] + 4
+        stats = modules.setdefault(address, {"transactions": 0, "crcFailures": 0, "timeouts": 0, "latency": []})
+        stats["transactions"] += 1
+        stats["latency"].append(rxTime - txTime)
+        if len(rx) < expected:
+            stats["timeouts"] += 1
+        elif not checkFrame(rx):
+            stats["crcFailures"] += 1
+        elif not write and tx[1] <= 1 and tx[1] + tx[2] >= 1 + ADC_BYTES:
+            adc.append((txTime, address, struct.unpack_from('>9H', rx, 3 + 1 - tx[1])))
+
+    report = {"start": reader.wallStart, "duration": (last - first) if first is not None else 0.0, "modules": {}}
+    raw = np.array([words for t, address, words in adc], dtype=np.uint16).reshape(-1, 9)
+    addresses = np.array([address for t, address, words in adc], dtype=np.uint8)
+    cells = cellVolts(raw[:, 1:7])
+    temps = temperatures(raw[:, 7:])
+    for address, stats in sorted(modules.items()):
+        latency = np.array(stats.pop("latency"))
+        stats["latencyMean"] = float(latency.mean())
+        stats["latencyP99"] = float(np.percentile(latency, 99))
+        stats["latencyMax"] = float(latency.max())
+        rows = addresses == address
+        if rows.any():
+            stats["readings"] = int(rows.sum())
+            stats["cellVoltMin"] = cells[rows].min(axis=0).tolist()
+            stats["cellVoltMax"] = cells[rows].max(axis=0).tolist()
+            stats["cellVoltLast"] = cells[rows][-1].tolist()
+            stats["moduleVoltLast"] = float(moduleVolts(raw[rows][-1:, 0])[0])
+            stats["temperaturesLast"] = temps[rows][-1].tolist()
+        report["modules"][address] = stats
+    return report
+
+def main(path):
+    started = time.perf_counter()
+    report = analyze(path)
+    print('%s: %.1f s of traffic analyzed in %.2f s' % (path, report["duration"], time.perf_counter() - started))
+    for address, stats in report["modules"].items():
+        line = '%2d: %7d transactions %5d CRC failures %5d timeouts latency mean %.3f ms p99 %.3f ms' % (
+            address, stats["transactions"], stats["crcFailures"], stats["timeouts"],
+            stats["latencyMean"] * 1e3, stats["latencyP99"] * 1e3)
+        if "cellVoltLast" in stats:
+            line += ' cells ' + ' '.join('%.3f' % v for v in stats["cellVoltLast"])
+        print(line)
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.exit('usage: BMSCapture.py capture.bmscap')
+    main(sys.argv[1])
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+"""
+Command line entry point
+
+The BMS* modules are a library: importing them opens no port and
+configures no logging, and a BMSModuleManager only talks to the chain once
+connected. This script wires them together.
+
+usage: BMSCli.py [-p /dev/ttyUSB1] [--simulate N] [-v] scan
+       BMSCli.py monitor [--interval 120] [--web 8080] [--db teslabms.db] [--store DIR] [--metrics FILE] [--capture FILE]
+       BMSCli.py balance [--duration 60] [--tolerance 0.05]
+       BMSCli.py dump [--registers]
+"""
+
+import argparse
+import json
+import logging
+import sys
+import time
+
+from BMSModuleManager import BMSModuleManager, TOPOLOGY_FILE
+
+def openManager(args):
+    if args.simulate:
+        from BMSSimulator import SimulatedChain
+        port = SimulatedChain(args.simulate, realtime=True)
+    else:
+        port = args.port
+    if args.capture:
+        from BMSUtils import Comms
+        #started before the manager so the enumeration is recorded too, main() closes it
+        args.comms = Comms(port)
+        args.comms.startCapture(args.capture)
+    #a simulated chain must never overwrite the topology file of the real one
+    return BMSModuleManager(port, topologyFile=None if args.simulate else args.topology or None)
+
+def printPack(bmsmm):
+    print('pack %.3f V  cells %.3f - %.3f V  %s' % (bmsmm.packVolt, bmsmm.LowCellVolt, bmsmm.HighCellVolt,
+                                                     'FAULTED' if bmsmm.isFaulted else 'ok'))
+    for module in bmsmm.modules:
+        print('%2d: %7.3f V  %s  %5.1f %5.1f C  alerts %02X faults %02X' % (
+            module.moduleAddress, module.moduleVolt, ' '.join('%.3f' % v for v in module.cellVolt),
+            module.temperatures[0], module.temperatures[1], module.alerts, module.faults))
+
+def scan(args):
+    bmsmm = openManager(args)
+    #always enumerate the chain again instead of connect, the topology file is rewritten
+    bmsmm.autoAssignModuleAddresses()
+    bmsmm.saveTopology()
+    bmsmm.clearFaults()
+    print('%d modules found' % len(bmsmm.modules))
+    if bmsmm.modules:
+        bmsmm.readAllVoltTemp()
+        printPack(bmsmm)
+
+def monitor(args):
+    #connected first, the store is sized on the modules found
+    bmsmm = openManager(args).connect()
+    commands = None
+    if args.db:
+        from BMSDatabase import BMSDatabase
+        commands = BMSDatabase(args.db)
+        bmsmm.listeners.append(commands.recordSweep)
+    if args.store:
+        from BMSStore import SampleStore
+        bmsmm.listeners.append(SampleStore(args.store, len(bmsmm.modules)).recordSweep)
+    if args.metrics:
+        from BMSMetrics import METRICS
+        bmsmm.listeners.append(lambda manager: METRICS.writeFile(args.metrics))
+    if args.web:
+        from BMSWeb import BMSWebServer
+        web = BMSWebServer(('', args.web), commands)
+        commands = web.commands
+        bmsmm.listeners.append(web.publish)
+        web.start()
+    bmsmm.run(args.interval, commands)
+
+def balance(args):
+    bmsmm = openManager(args)
+    bmsmm.readAllVoltTemp()
+    print('cell delta %.3f V' % bmsmm.pack.cellDelta())
+    bmsmm.balancer.tolerance = args.tolerance
+    bmsmm.balanceCells(args.duration)
+    #keep the module timers armed until the balancing ends
+    while bmsmm.balancer.active():
+        time.sleep(max(0.0, min(bmsmm.balancer.nextStep() - time.monotonic(), 1.0)))
+        bmsmm.balancer.step()
+    bmsmm.readAllVoltTemp()
+    print('cell delta %.3f V' % bmsmm.pack.cellDelta())
+
+def dump(args):
+    bmsmm = openManager(args).connect()
+    if args.registers:
+        for module in bmsmm.modules:
+            image = module.readImage()
+            if not image:
+                print('%2d: no answer' % module.moduleAddress)
+                continue
+            print('%2d: %s' % (module.moduleAddress, image.raw.hex(' ')))
+            print('    ' + ' '.join('%s=%02X' % (name, value) for name, value in image._asdict().items() if name != 'raw'))
+        return
+    bmsmm.readAllVoltTemp()
+    json.dump(bmsmm.snapshot(), sys.stdout, indent=1)
+    print()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tesla BMS module chain")
+    parser.add_argument("-p", "--port", default="/dev/ttyUSB1", help="serial port of the chain")
+    parser.add_argument("--simulate", type=int, metavar="N", help="use a simulated chain of N modules instead of the port")
+    parser.add_argument("--topology", default=TOPOLOGY_FILE, help="topology file, empty to always enumerate, never used with --simulate")
+    parser.add_argument("--capture", help="record the UART traffic to this file, see BMSCapture")
+    parser.add_argument("-v", "--verbose", action="count", default=0, help="-v for info, -vv for debug logging")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("scan", help="enumerate the chain and read it once").set_defaults(fn=scan)
+
+    parser_monitor = commands.add_parser("monitor", help="run the control loop")
+    parser_monitor.add_argument("--interval", type=float, help="seconds between sweeps, adapts to the pack activity by default")
+    parser_monitor.add_argument("--web", type=int, metavar="PORT", help="serve the status API on this port")
+    parser_monitor.add_argument("--db", help="SQLite database for sweeps and commands")
+    parser_monitor.add_argument("--store", metavar="DIR", help="binary sample store directory")
+    parser_monitor.add_argument("--metrics", metavar="FILE", help="Prometheus text file rewritten after every sweep")
+    parser_monitor.set_defaults(fn=monitor)
+
+    parser_balance = commands.add_parser("balance", help="balance the cells and wait until it is done")
+    parser_balance.add_argument("--duration", type=int, default=60, help="seconds of balancing")
+    parser_balance.add_argument("--tolerance", type=float, default=0.05, help="V above the lowest cell that get bled")
+    parser_balance.set_defaults(fn=balance)
+
+    parser_dump = commands.add_parser("dump", help="read the pack once and print it as JSON")
+    parser_dump.add_argument("--registers", action="store_true", help="print the register image of every module instead")
+    parser_dump.set_defaults(fn=dump)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=(logging.WARNING, logging.INFO, logging.DEBUG)[min(args.verbose, 2)])
+    args.comms = None
+    try:
+        args.fn(args)
+    finally:
+        #monitor only ends on an exception or ^C, the tail of the capture is what explains it
+        if args.comms is not None:
+            args.comms.stopCapture()
+
+if __name__ == "__main__":
+    main()
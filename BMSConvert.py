@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+"""
+Conversion of raw ADC words into volts and degrees C
+
+The ADC is 14 bits so every temperature code is converted ahead of time
+into a lookup table, one per sensor channel. Cell and module voltages are
+a single scale factor applied to the whole pack frame at once.
+Run this file directly to validate the tables against the formulas and
+benchmark them.
+"""
+
+import math
+import time
+
+import numpy as np
+
+ADC_MAX = 0x3FFF
+
+MODULE_VOLT_LSB = 0.0020346293922562
+CELL_VOLT_LSB = 0.000381493
+
+#thermistor Steinhart-Hart constants
+THERM_A = 0.0007610373573
+THERM_B = 0.0002728524832
+THERM_C = 0.0000001022822735
+#(offset, divider) of the two temperature channels
+THERM_CHANNELS = ((2, 33046.0), (9, 33068.0))
+
+def tempFromRaw(raw, offset, divider):
+    #reference formula, as originally used in BMSModule.readVoltTemp
+    tempTemp = (1.78 / ((float(raw) + offset) / divider) - 3.57)
+    tempTemp *= 1000.0
+    tempCalc = 1.0 / (THERM_A + (THERM_B * math.log(tempTemp)) + (math.pow(math.log(tempTemp), 3) * THERM_C))
+    return tempCalc - 273.15
+
+def buildTempTable(offset, divider):
+    raw = np.arange(ADC_MAX + 1, dtype=np.float64)
+    logR = np.log((1.78 / ((raw + offset) / divider) - 3.57) * 1000.0)
+    return 1.0 / (THERM_A + THERM_B * logR + THERM_C * logR ** 3) - 273.15
+
+#TEMP_TABLE[channel][raw] in degrees C
+TEMP_TABLE = np.stack([buildTempTable(offset, divider) for offset, divider in THERM_CHANNELS])
+
+def moduleVolts(raw):
+    return raw * MODULE_VOLT_LSB
+
+def cellVolts(raw):
+    return raw * CELL_VOLT_LSB
+
+def temperatures(raw):
+    #raw is (..., 2), one column per channel
+    raw = np.minimum(raw, ADC_MAX)
+    return np.stack([TEMP_TABLE[0][raw[..., 0]], TEMP_TABLE[1][raw[..., 1]]], axis=-1)
+
+def validate():
+    worst = 0.0
+    for channel, (offset, divider) in enumerate(THERM_CHANNELS):
+        for raw in range(ADC_MAX + 1):
+            worst = max(worst, abs(TEMP_TABLE[channel][raw] - tempFromRaw(raw, offset, divider)))
+    print("worst table error %.3g C" % worst)
+    return worst
+
+def benchmark(numModules=62, repeat=200):
+    rng = np.random.default_rng(0)
+    raw = rng.integers(0, ADC_MAX + 1, size=(numModules, 2))
+
+    start = time.perf_counter()
+    for i in range(repeat):
+        [[tempFromRaw(raw[m, c], *THERM_CHANNELS[c]) for c in range(2)] for m in range(numModules)]
+    formula = (time.perf_counter() - start) / repeat
+
+    start = time.perf_counter()
+    for i in range(repeat):
+        temperatures(raw)
+    table = (time.perf_counter() - start) / repeat
+    print("%d modules: formula %.1f us/sweep, table %.1f us/sweep" % (numModules, formula * 1e6, table * 1e6))
+
+if __name__ == "__main__":
+    validate()
+    benchmark()
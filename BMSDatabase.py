@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+"""
+SQLite persistence for sweeps, rollups and commands from the website
+
+The database runs in WAL mode. Sweeps are queued by the control loop and
+written in batches by a background thread so the UART loop never waits
+on disk. Every cell sample also updates 1 minute and 1 hour min/max/mean
+rollups so month long dashboards query the rollups, not the raw rows, and
+raw rows older than retention are deleted by the same thread.
+Commands queued by the website sit in an indexed table the control loop
+polls cheaply.
+
+usage: db = BMSDatabase('teslabms.db')
+       bmsmm.listeners.append(db.recordSweep)
+       for command in db.pollCommands(): ...
+"""
+
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+ROLLUPS = (('cell_rollup_1m', 60), ('cell_rollup_1h', 3600))
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS cell_samples (
+    ts REAL NOT NULL, module INTEGER NOT NULL, cell INTEGER NOT NULL, volt REAL);
+CREATE INDEX IF NOT EXISTS cell_samples_ts ON cell_samples (ts);
+CREATE TABLE IF NOT EXISTS module_samples (
+    ts REAL NOT NULL, module INTEGER NOT NULL, volt REAL, temp1 REAL, temp2 REAL,
+    alerts INTEGER, faults INTEGER, cov INTEGER, cuv INTEGER);
+CREATE INDEX IF NOT EXISTS module_samples_ts ON module_samples (ts);
+CREATE TABLE IF NOT EXISTS commands (
+    id INTEGER PRIMARY KEY, created REAL NOT NULL, command TEXT NOT NULL, args TEXT,
+    status TEXT NOT NULL DEFAULT 'pending', done REAL);
+CREATE INDEX IF NOT EXISTS commands_pending ON commands (id) WHERE status = 'pending';
+'''
+
+ROLLUP_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS %s (
+    bucket INTEGER NOT NULL, module INTEGER NOT NULL, cell INTEGER NOT NULL,
+    min REAL, max REAL, sum REAL, count INTEGER,
+    PRIMARY KEY (bucket, module, cell)) WITHOUT ROWID;
+'''
+
+ROLLUP_UPSERT = '''
+INSERT INTO %s (bucket, module, cell, min, max, sum, count) VALUES (?, ?, ?, ?, ?, ?, 1)
+ON CONFLICT (bucket, module, cell) DO UPDATE SET
+    min = min(min, excluded.min), max = max(max, excluded.max),
+    sum = sum + excluded.sum, count = count + 1
+'''
+
+class BMSDatabase:
+
+    def __init__(self, path, batchSize=60, flushInterval=1.0, retention=86400, pruneInterval=600):
+        self.path = path
+        self.batchSize = batchSize              #sweeps written per transaction at most
+        self.flushInterval = flushInterval      #seconds a queued sweep may wait before being written
+        self.retention = retention              #seconds of raw samples kept, they live on in the rollups, None keeps all
+        self.pruneInterval = pruneInterval      #seconds of samples between two retention deletes
+        self.pruned = None                      #sample time of the last retention delete
+        self.local = threading.local()
+        db = self.connection()
+        db.executescript(SCHEMA + ''.join(ROLLUP_SCHEMA % name for name, seconds in ROLLUPS))
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self.__write, name='bms-db-writer', daemon=True)
+        self.writer.start()
+
+    def connection(self):
+        #one connection per thread
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+        return db
+
+    def recordSweep(self, manager, timestamp=None):
+        #BMSModuleManager listener, only copies the values, the writer thread does the I/O
+        ts = time.time() if timestamp is None else timestamp
+        modules = []
+        for module in manager.modules:
+            modules.append((module.moduleAddress, [float(v) for v in module.cellVolt], float(module.moduleVolt),
+                            float(module.temperatures[0]), float(module.temperatures[1]),
+                            module.alerts, module.faults, module.COVFaults, module.CUVFaults))
+        self.queue.put((ts, modules))
+
+    def flush(self):
+        #block until every queued sweep is on disk
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.writer.join()
+
+    def __write(self):
+        db = self.connection()
+        running = True
+        while running:
+            sweeps = [self.queue.get()]
+            deadline = time.monotonic() + self.flushInterval
+            #gather what else arrives before the deadline so each transaction carries many rows
+            while sweeps[-1] is not None and len(sweeps) < self.batchSize:
+                try:
+                    sweeps.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            if sweeps[-1] is None:
+                running = False
+            written = [sweep for sweep in sweeps if sweep is not None]
+            try:
+                self.__insert(db, written)
+                if written:
+                    self.__prune(db, max(ts for ts, modules in written))
+            except sqlite3.Error as e:
+                logging.error('[-] Could not write %d sweeps: %s' % (len(sweeps), e))
+            for sweep in sweeps:
+                self.queue.task_done()
+
+    def __insert(self, db, sweeps):
+        cells = []
+        modules = []
+        for ts, sweep in sweeps:
+            for address, cellVolt, volt, temp1, temp2, alerts, faults, cov, cuv in sweep:
+                modules.append((ts, address, volt, temp1, temp2, alerts, faults, cov, cuv))
+                cells.extend((ts, address, cell, v) for cell, v in enumerate(cellVolt) if v == v)
+        with db:
+            db.executemany('INSERT INTO module_samples VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', modules)
+            db.executemany('INSERT INTO cell_samples VALUES (?, ?, ?, ?)', cells)
+            for name, seconds in ROLLUPS:
+                db.executemany(ROLLUP_UPSERT % name,
+                               ((int(ts // seconds) * seconds, address, cell, v, v, v) for ts, address, cell, v in cells))
+
+    def __prune(self, db, now):
+        #drop the raw rows past the retention, the rollups already hold them
+        if self.retention is None or (self.pruned is not None and now - self.pruned < self.pruneInterval):
+            return
+        self.pruned = now
+        with db:
+            cells = db.execute('DELETE FROM cell_samples WHERE ts < ?', (now - self.retention,)).rowcount
+            db.execute('DELETE FROM module_samples WHERE ts < ?', (now - self.retention,))
+        if cells:
+            logging.debug('[!] Pruned %d raw cell samples' % cells)
+
+    def rollups(self, resolution='1m', start=None, end=None, module=None):
+        #(bucket, module, cell, min, max, mean) rows from the 1m or 1h rollup
+        name = 'cell_rollup_%s' % resolution
+        if name not in dict(ROLLUPS):
+            raise ValueError('unknown rollup resolution %s' % resolution)
+        query = 'SELECT bucket, module, cell, min, max, sum / count FROM %s WHERE bucket >= ? AND bucket < ?' % name
+        args = [start if start is not None else 0, end if end is not None else 2 ** 62]
+        if module is not None:
+            query += ' AND module = ?'
+            args.append(module)
+        return self.connection().execute(query + ' ORDER BY bucket, module, cell', args).fetchall()
+
+    def cellSamples(self, start, end, module=None):
+        query = 'SELECT ts, module, cell, volt FROM cell_samples WHERE ts >= ? AND ts < ?'
+        args = [start, end]
+        if module is not None:
+            query += ' AND module = ?'
+            args.append(module)
+        return self.connection().execute(query + ' ORDER BY ts', args).fetchall()
+
+    def queueCommand(self, command, args=None):
+        #called by the website, returns the command id
+        db = self.connection()
+        with db:
+            cursor = db.execute('INSERT INTO commands (created, command, args) VALUES (?, ?, ?)',
+                                (time.time(), command, json.dumps(args or {})))
+        return cursor.lastrowid
+
+    def pollCommands(self):
+        #pending commands in the order they were queued, served by the partial index
+        rows = self.connection().execute(
+            "SELECT id, command, args FROM commands WHERE status = 'pending' ORDER BY id").fetchall()
+        return [(id, command, json.loads(args) if args else {}) for id, command, args in rows]
+
+    def completeCommand(self, id, status='done'):
+        db = self.connection()
+        with db:
+            db.execute('UPDATE commands SET status = ?, done = ? WHERE id = ?', (status, time.time(), id))
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+"""
+Counters and latency histograms of the UART link in Prometheus text format
+
+Comms records every transaction by type, module address and register with
+its bytes, CRC failures and timeouts. The manager adds sweep and fault poll
+durations and retry adds the retried transactions. Recording is a few
+dictionary updates under a lock, cheap next to a transaction on the wire,
+so it stays on; setting Comms.metrics to None turns it off for one link.
+
+usage: METRICS.writeFile('/var/lib/node_exporter/teslabms.prom')
+       or GET /metrics on BMSWeb.BMSWebServer
+"""
+
+import os
+import threading
+from bisect import bisect_left
+
+#seconds, a transaction on a healthy chain takes 0.2 to 1 ms and times out at FRAME_TIMEOUT
+LATENCY_BUCKETS = (0.00025, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1)
+SWEEP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+#name: (type, help, label names)
+METRIC_TYPES = {
+    'bms_transactions_total': ('counter', 'UART transactions', ('link', 'type', 'module', 'register')),
+    'bms_transaction_seconds': ('histogram', 'UART transaction latency from TX to complete reply', ('link', 'type', 'module', 'register')),
+    'bms_tx_bytes_total': ('counter', 'Bytes sent to the chain', ('link',)),
+    'bms_rx_bytes_total': ('counter', 'Bytes received from the chain', ('link',)),
+    'bms_crc_failures_total': ('counter', 'Replies with a bad CRC', ('link', 'module')),
+    'bms_timeouts_total': ('counter', 'Replies not complete before the frame timeout', ('link', 'module')),
+    'bms_writes_saved_total': ('counter', 'Writes skipped because the register already held the value', ('link',)),
+    'bms_retries_total': ('counter', 'Transactions retried until they succeeded or gave up', ('operation',)),
+    'bms_sweep_seconds': ('histogram', 'Duration of a full measurement sweep', ('link',)),
+    'bms_fault_poll_seconds': ('histogram', 'Duration of a fault and alert poll', ('link',)),
+}
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)    #last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}          #(name, label values) -> value
+        self.histograms = {}        #(name, label values) -> Histogram
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, bounds=SWEEP_BUCKETS):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(bounds)
+            histogram.observe(value)
+
+    def transaction(self, link, type, module, register, txBytes, rxBytes, seconds, error=None):
+        #everything a Comms transaction records under a single lock
+        labels = (link, type, module, register)
+        counters = self.counters
+        with self.lock:
+            key = ('bms_transactions_total', labels)
+            counters[key] = counters.get(key, 0) + 1
+            key = ('bms_tx_bytes_total', (link,))
+            counters[key] = counters.get(key, 0) + txBytes
+            key = ('bms_rx_bytes_total', (link,))
+            counters[key] = counters.get(key, 0) + rxBytes
+            if error:
+                key = (error, (link, module))
+                counters[key] = counters.get(key, 0) + 1
+            key = ('bms_transaction_seconds', labels)
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(LATENCY_BUCKETS)
+            histogram.observe(seconds)
+
+    def get(self, name, labels=()):
+        return self.counters.get((name, labels), 0)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def render(self):
+        #Prometheus text exposition format
+        with self.lock:
+            counters = sorted(self.counters.items(), key=str)
+            histograms = sorted(((key, list(h.counts), h.sum, h.count, h.bounds) for key, h in self.histograms.items()), key=str)
+        lines = []
+        for name, (type, help, labelNames) in METRIC_TYPES.items():
+            series = [(labels, value) for (n, labels), value in counters if n == name]
+            series += [(labels, value) for (n, labels), *value in histograms if n == name]
+            if not series:
+                continue
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, type))
+            for labels, value in series:
+                text = ','.join('%s="%s"' % (n, str(v).replace('\\', '\\\\').replace('"', '\\"')) for n, v in zip(labelNames, labels))
+                if type == 'counter':
+                    lines.append('%s{%s} %s' % (name, text, value) if text else '%s %s' % (name, value))
+                    continue
+                counts, total, count, bounds = value
+                cumulative = 0
+                sep = ',' if text else ''
+                for bound, n in zip(bounds + (float('inf'),), counts):
+                    cumulative += n
+                    lines.append('%s_bucket{%s%sle="%s"} %d' % (name, text, sep, '+Inf' if bound == float('inf') else repr(bound), cumulative))
+                labelText = '{%s}' % text if text else ''
+                lines.append('%s_sum%s %r' % (name, labelText, total))
+                lines.append('%s_count%s %d' % (name, labelText, count))
+        return '\n'.join(lines) + '\n'
+
+    def writeFile(self, path):
+        #atomic replace so a scraper (ie the node_exporter textfile collector) never sees half a file
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+#registry shared by every link and manager in the process
+METRICS = Metrics()
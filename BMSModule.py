@@ -1,21 +1,37 @@
 #!/usr/bin/env python3
 
 from BMSUtils import *
+from BMSPack import PackState
 import logging
-import math
+import time
+
+#registers read every sweep: ModuleV, CellV1-6, Temp1, Temp2 and alerts, faults, COV, CUV
+SCAN_BLOCKS = ((REG_GPAI, ADC_BLOCK.size), (REG_ALERT_STATUS, STATUS_BLOCK.size))
+SCAN_READS = planReads(SCAN_BLOCKS)
+
+def packRow(name):
+    #property reading and writing this module's row of a PackState array
+    def get(self):
+        return getattr(self.pack, name)[self.row]
+    def set(self, value):
+        getattr(self.pack, name)[self.row] = value
+    return property(get, set)
 
 class BMSModule:
 
+    #properties stored in the pack arrays, see BMSPack.PackState
+    cellVolt = packRow('cellVolt')
+    lowestCellVolt = packRow('lowestCellVolt')
+    highestCellVolt = packRow('highestCellVolt')
+    moduleVolt = packRow('moduleVolt')
+    moduleVoltAdc = packRow('moduleVoltAdc')
+    temperatures = packRow('temperatures')
+    lowestTemperature = packRow('lowestTemperature')
+    highestTemperature = packRow('highestTemperature')
+    lowestModuleVolt = packRow('lowestModuleVolt')
+    highestModuleVolt = packRow('highestModuleVolt')
+
     #properties
-    cellVolt = [None] * 6
-    lowestCellVolt = [200.0] * 6
-    highestCellVolt = [0.0] * 6
-    moduleVolt = 0
-    temperatures = [None] * 2
-    lowestTemperature = 200.0
-    highestTemperature = -100.0
-    lowestModuleVolt = 200.0
-    highestModuleVolt = 0.0
     IgnoreCell = 0
     exists = 0
     alerts = 0
@@ -25,63 +41,102 @@ class BMSModule:
     sensor = 0
     moduleAddress = 0
     scells = 0
+    image = None        #RegisterImage of the last readImage, see checkImage
 
     def readStatus(self):
-        buf = self.comms.read(self.moduleAddress, REG_ALERT_STATUS, 0x04)
-        (self.alerts, self.faults, self.COVFaults, self.CUVFaults) = buf[3:7]
+        buf = self.comms.readView(self.moduleAddress, REG_ALERT_STATUS, 0x04)
+        if not buf:
+            logging.debug("Module %i   failed to read status", self.moduleAddress)
+            return False
+        (self.alerts, self.faults, self.COVFaults, self.CUVFaults) = STATUS_BLOCK.unpack_from(buf, 3)
+        return True
+
+    def status(self):
+        return (self.alerts, self.faults, self.COVFaults, self.CUVFaults)
+
+    def hasFault(self):
+        #over/under voltage, over temperature or internal fault latched on the module
+        return bool(self.alerts & PACK_ALERTS or self.faults & PACK_FAULTS)
 
-    def readVoltTemp(self):
-        self.readStatus()
-        logging.debug("Module %i   alerts=%X   faults=%X   COV=%X   CUV=%X" % (self.moduleAddress, self.alerts, self.faults, self.COVFaults, self.CUVFaults))
+    def readImage(self):
+        #whole register image in one read, cached and its status bytes decoded
+        image = self.comms.readImage(self.moduleAddress)
+        if not image:
+            logging.debug("Module %i   failed to read the register image", self.moduleAddress)
+            return False
+        (self.alerts, self.faults, self.COVFaults, self.CUVFaults) = (image.alerts, image.faults, image.COVFaults, image.CUVFaults)
+        self.image = image
+        return image
+
+    def checkImage(self):
+        #compare a fresh register image with the cached one
+        #returns (changed config fields {name: (old, new)}, reset) or False when the module did not answer
+        previous = self.image
+        image = self.readImage()
+        if not image:
+            return False
+        reset = imageShowsReset(image, self.moduleAddress)
+        changes = diffImages(previous, image) if previous is not None else {}
+        if reset:
+            logging.warning('[-] Module %d was reset' % self.moduleAddress)
+        elif changes:
+            logging.warning('[-] Module %d configuration drifted: %s' % (self.moduleAddress, changes))
+        return changes, reset
+
+    def startConversion(self):
         #ADC Auto mode, read every ADC input we can (Both Temps, Pack, 6 cells)
         self.comms.write(self.moduleAddress, REG_ADC_CTRL, 0x3d)
         #enable temperature measurement VSS pins
         self.comms.write(self.moduleAddress, REG_IO_CTRL, 0x03)
         #start all ADC conversions
         self.comms.write(self.moduleAddress, REG_ADC_CONV, 0x01)
-        #start reading registers at the module voltage registers
-        #read 18 bytes (Each value takes 2 - ModuleV, CellV1-6, Temp1, Temp2)
-        buf = self.comms.read(self.moduleAddress, REG_GPAI, 0x12)
-        retModuleVolt = float(u16(buf[3:5])) * 0.0020346293922562
-        self.highestModuleVolt = max(self.highestModuleVolt, retModuleVolt)
-        self.lowestModuleVolt = min(self.lowestModuleVolt, retModuleVolt)
-        self.moduleVolt = 0.0
-        for i in range(len(self.cellVolt)):
-            self.cellVolt[i] = float(u16(buf[5+(i*2) : 7+(i*2)])) * 0.000381493
-            self.highestCellVolt[i] = max(self.highestCellVolt[i],  self.cellVolt[i])
-            self.lowestCellVolt[i] = min(self.lowestCellVolt[i], self.cellVolt[i])
-            self.moduleVolt += self.cellVolt[i]
-
-        tempTemp = (1.78 / ((float(u16(buf[17:19])) + 2) / 33046.0) - 3.57)
-        tempTemp *= 1000.0
-        tempCalc =  1.0 / (0.0007610373573 + (0.0002728524832 * math.log(tempTemp)) + (math.pow(math.log(tempTemp), 3) * 0.0000001022822735))
-        self.temperatures[0] = tempCalc - 273.15
-
-        tempTemp = (1.78 / ((float(u16(buf[19:21])) + 9) / 33068.0) - 3.57)
-        tempTemp *= 1000.0
-        tempCalc =  1.0 / (0.0007610373573 + (0.0002728524832 * math.log(tempTemp)) + (math.pow(math.log(tempTemp), 3) * 0.0000001022822735))
-        self.temperatures[1] = tempCalc - 273.15
-
-        self.lowestTemperature = min(self.lowestTemperature, self.temperatures[0], self.temperatures[1])
-        self.highestTemperature = max(self.highestTemperature, self.temperatures[0], self.temperatures[1])
+        time.sleep(ADC_CONV_DELAY)
 
+    def readVoltTemp(self, convert=True):
+        #convert=False only reads the results of a conversion already triggered (ie by a broadcast)
+        if not self.readValues(convert):
+            return False
+        self.pack.update(slice(self.row, self.row + 1))
         logging.debug("Got voltage and temperature readings")
+        return True
+
+    def readValues(self, convert=True):
+        #status and raw ADC words into the pack row with as few reads as possible, conversion is left to PackState.update
+        if convert:
+            self.startConversion()
+        for start, numBytes in SCAN_READS:
+            buf = self.comms.readView(self.moduleAddress, start, numBytes)
+            if not buf:
+                logging.debug("Module %i   failed to read voltage and temperature", self.moduleAddress)
+                return False
+            self.decodeScan(buf, start, numBytes)
+        logging.debug("Module %i   alerts=%X   faults=%X   COV=%X   CUV=%X", self.moduleAddress, self.alerts, self.faults, self.COVFaults, self.CUVFaults)
+        return True
 
-    def __init__(self, serialConnection):
+    def decodeScan(self, buf, start, numBytes):
+        #decode every scan block contained in a reply to a read of numBytes at register start
+        end = start + numBytes
+        if start <= REG_ALERT_STATUS and REG_ALERT_STATUS + STATUS_BLOCK.size <= end:
+            (self.alerts, self.faults, self.COVFaults, self.CUVFaults) = STATUS_BLOCK.unpack_from(buf, 3 + REG_ALERT_STATUS - start)
+        if start <= REG_GPAI and REG_GPAI + ADC_BLOCK.size <= end:
+            self.pack.rawAdc[self.row] = ADC_BLOCK.unpack_from(buf, 3 + REG_GPAI - start)
+
+    def __init__(self, serialConnection, pack=None, row=0):
         self.comms = serialConnection
         #self.comms.test()
+        #a module on its own gets a pack of one
+        self.pack = pack if pack is not None else PackState(1)
+        self.row = row
         self.clearModule()
 
+    def attach(self, pack, row):
+        #move the module onto row of a pack wide PackState
+        self.pack = pack
+        self.row = row
+        self.pack.clear(slice(row, row + 1))
+
     def clearModule(self):
-        self.cellVolt = [None] * 6
-        self.lowestCellVolt = [200.0] * 6
-        self.highestCellVolt = [0.0] * 6
-        self.moduleVolt = 0
-        self.temperatures = [None] * 2
-        self.lowestTemperature = 200.0
-        self.highestTemperature = -100.0
-        self.lowestModuleVolt = 200.0
-        self.highestModuleVolt = 0.0
+        self.pack.clear(slice(self.row, self.row + 1))
         self.IgnoreCell = 0
         self.exists = 0
         self.alerts = 0
@@ -93,7 +148,7 @@ class BMSModule:
         self.scells = 0
 
     def stopBalancing(self):
-        self.comms.write(moduleAddress, REG_BAL_CTRL, 0x00)
+        self.comms.write(self.moduleAddress, REG_BAL_CTRL, 0x00)
 
 
 #module1 = BMSModule(Comms('/dev/ttyUSB1'))
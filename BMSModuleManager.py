@@ -2,10 +2,17 @@
 
 from BMSUtils import *
 from BMSModule import BMSModule
+from BMSPack import PackState
+from BMSBalancer import BMSBalancer, BALANCE_SETTLE
+from BMSPlanner import BalancePlanner
+from BMSActivity import PackActivity
+from BMSStats import CellStats
+import json
 import time
 import logging
 
-logging.basicConfig(level=logging.DEBUG)
+TOPOLOGY_FILE = 'topology.json'
+MAX_BALANCE_DURATION = 24 * 3600    #seconds, longest balance command accepted
 
 class BMSModuleManager:
 
@@ -18,91 +25,306 @@ class BMSModuleManager:
     lowestPackTemp = 0.0
     highestPackTemp = 0.0
     modules = []               # store data for as many modules as we've configured for.
+    pack = PackState(0)        # cell voltages and temperatures of every module, see BMSPack
+    sweepRows = []             # pack rows read by the last sweep, a module that failed keeps its previous values
     batteryID = 0
     #numFoundModules = 0        # The number of modules that seem to exist
     isFaulted = False
+    asleep = False
+    connected = False          # modules restored or enumerated, see connect
+    manualUntil = 0.0          # balancer clock time a balance command runs until, the planner waits for it
     spack = 0
 
-    def __init__(self):
-        self.comms = Comms('/dev/ttyUSB1')
+    def __init__(self, serPort='/dev/ttyUSB1', topologyFile=TOPOLOGY_FILE, faultLine=None, name=None):
+        #serPort is a device name or an open serial like object (ie BMSSimulator.SimulatedChain)
+        #name labels the metrics of this chain, the port by default
+        self.comms = Comms(serPort, name=name)
+        #callable returning True while the modules assert the fault or alert line, None polls the status registers
+        self.faultLine = faultLine
+        #chain discovered on a previous start, None always re-enumerates
+        self.topologyFile = topologyFile
+        #callables run with the manager after every sweep, ie BMSStore.SampleStore.recordSweep
+        self.listeners = []
+        #per module balancing state, stepped from the main loop
+        self.balancer = BMSBalancer(self)
+        #per cell bleed times from a learned bleed rate model, re-planned after every sweep
+        self.planner = BalancePlanner(self)
+        #charging/discharging/idle detection, picks the sweep interval and puts idle boards to sleep
+        self.activity = PackActivity()
+        #per cell running statistics and outlier detection, fed by every sweep
+        self.stats = CellStats()
+        #no bus traffic until connect, called by the first sweep, poll or command if nobody did
 
-        #reset all modules and assign adresses
-        self.autoAssignModuleAddresses()
+    def connect(self):
+        #reuse the known topology, otherwise reset all modules and assign adresses
+        if not self.restoreTopology():
+            self.autoAssignModuleAddresses()
+            self.saveTopology()
 
         #clear all faults
         self.clearFaults()
+        return self
 
-        #control loop
-            # Read values from boards
+    def run(self, interval=None, commands=None, minStep=0.5, faultInterval=1.0, checkInterval=3600):
+        #control loop, commands is a BMSDatabase or BMSWeb.CommandQueue filled by the website
+        #interval fixes the seconds between sweeps, None lets self.activity adapt it to the pack
+        #faults are polled every faultInterval seconds in between, see pollFaults
+        #register images are checked for drift and resets every checkInterval seconds, see checkModules
+        if not self.connected:
+            self.connect()
+        due = {"sweep": time.monotonic(), "poll": time.monotonic() + faultInterval, "check": time.monotonic()}
+        while True:
+            time.sleep(max(minStep, self.tick(due, interval, commands, faultInterval, checkInterval)))
+
+    def tick(self, due, interval=None, commands=None, faultInterval=1.0, checkInterval=3600):
+        #one turn of run, due holds the monotonic times of the next sweep, poll and check
+        #returns the seconds until the next one is due, BMSAsync turns the same loop from asyncio
+        if time.monotonic() >= due["sweep"]:
+            due["sweep"] = time.monotonic() + self.sweep(interval, commands)
+            # configuration drift and unexpected resets
+            if time.monotonic() >= due["check"] and not self.asleep:
+                self.checkModules()
+                due["check"] = time.monotonic() + checkInterval
+        elif time.monotonic() >= due["poll"]:
+            # fast path, alerts and faults without a full sweep
+            self.pollFaults()
+            due["poll"] = time.monotonic() + faultInterval
+        # balancing transactions that are due, then wait until the next step, poll or sweep
+        nextStep = self.balancer.step()
+        return min(due["sweep"], due["poll"], nextStep) - time.monotonic()
+
+    def sweep(self, interval=None, commands=None):
+        #one pass of the control loop, returns the seconds to wait before the next one
+        # Read values from boards, listeners write db and publish the latest values
         self.readAllVoltTemp()
-            # write db with latest values
-            # read db for orders from website
-            # Perform orders (auto load balancing, clear faults ...)
-            # sleep 2 minute and redo.
-        self.balanceCells(7)
+        # read db for orders from website and perform them (clear faults, sleep ...)
+        if commands:
+            for id, command, args in commands.pollCommands():
+                try:
+                    done = self.runCommand(command, args)
+                except Exception:
+                    logging.exception('[-] Command %s %r failed' % (command, args))
+                    done = False
+                commands.completeCommand(id, 'done' if done else 'failed')
+        # auto load balancing, re-planned from fresh voltages every sweep unless a balance
+        # command is still running or the boards were put to sleep
+        if not self.asleep and self.balancer.clock() >= self.manualUntil:
+            self.planner.plan(2 * (interval or self.activity.slowInterval))
+        # sweep rate from the pack activity, idle boards go to sleep until the next sweep
+        adaptive = self.activity.update(self)
+        return interval or adaptive
+
+    def runCommand(self, command, args=None):
+        #commands come from the website, bad arguments fail the command and never the control loop
+        logging.debug('[!] Running command %s %r' % (command, args))
+        if args is None:
+            args = {}
+        elif not isinstance(args, dict):
+            logging.warning('[-] Bad arguments %r for command %s' % (args, command))
+            return False
+        if command == 'balance':
+            try:
+                duration = float(args.get('duration', 5))
+            except (TypeError, ValueError):
+                duration = None
+            if duration is None or not 0 < duration <= MAX_BALANCE_DURATION:
+                logging.warning('[-] Bad balance duration %r' % args.get('duration'))
+                return False
+            self.balanceCells(duration)
+        elif command == 'clearFaults':
+            self.clearFaults()
+        elif command == 'sleep':
+            self.sleepBoards()
+        elif command == 'wake':
+            self.wakeBoards()
+        else:
+            logging.warning('[-] Unknown command %s' % command)
+            return False
+        return True
+
+    def snapshot(self):
+        #latest values of the whole pack as plain python types, safe to hand to other threads
+        def number(value):
+            value = float(value)
+            return None if value != value else value
+        return {
+            "timestamp": time.time(),
+            "packVolt": number(self.packVolt),
+            "lowCellVolt": number(self.LowCellVolt),
+            "highCellVolt": number(self.HighCellVolt),
+            "isFaulted": self.isFaulted,
+            "modules": [{
+                "address": module.moduleAddress,
+                "moduleVolt": number(module.moduleVolt),
+                "cellVolt": [number(v) for v in module.cellVolt],
+                "temperatures": [number(v) for v in module.temperatures],
+                "alerts": module.alerts,
+                "faults": module.faults,
+                "COVFaults": module.COVFaults,
+                "CUVFaults": module.CUVFaults,
+            } for module in self.modules],
+            "outliers": [{"module": self.modules[row].moduleAddress, "cell": cell, "kind": kind, "score": score}
+                         for row, cell, kind, score in self.stats.outliers() if row < len(self.modules)],
+        }
 
     def balanceCells(self, duration=5):
-        #1 build array with all cell voltages
-        allCellsV = []
-        tolerance = 0.05 #anything within this V is good
-        for i in range(len(self.modules)):
-            module = self.modules[i]
-            allCellsV += module.cellVolt
-        minCellV = min(allCellsV)
+        #start bleeding the high cells for duration seconds and return, see BMSBalancer
+        if not self.connected:
+            self.connect()
+        self.balancer.plan(duration)
+        self.manualUntil = self.balancer.clock() + duration
+        self.balancer.step()
 
-        cellBalance = 0
-        for i in range(len(allCellsV)):
-            if allCellsV[i] > (minCellV + tolerance):
-                #compute module and cell
-                modIndex = i // 6
-                cellNum = i % 6
-                modAddr = modIndex + 1
-                cellBalance |= 1 << cellNum
+    def readAllVoltTemp(self, broadcast=True):
+        #broadcast=True converts every module at the same instant and then only reads the results
+        if not self.connected:
+            self.connect()
+        start = time.perf_counter()
+        self.packVolt = 0.0
+        if self.asleep:
+            self.wakeBoards()
+        #measurement window, the bleed resistors pull the cells down while they are on
+        if self.balancer.pause():
+            time.sleep(BALANCE_SETTLE)
+        try:
+            if broadcast:
+                self.startConversion()
 
-            #if balancing is required and if at last cell of module
-            if (cellBalance > 0) & (cellNum == (6 - 1) ):
-                logging.debug('[!] Setting balancing duration on Module: %d : 0x%X' % (modAddr,cellBalance))
-                self.comms.write(modAddr, REG_BAL_TIME, duration)
-                time.sleep(0.02)
-                self.comms.write(modAddr, REG_BAL_CTRL, cellBalance)
-                cellBalance = 0
+            rows = []
+            for module in self.modules:
+                logging.debug('[!] Module %i || Reading voltage and temperature values', module.moduleAddress)
+                if module.readValues(convert=not broadcast):
+                    rows.append(module.row)
+        finally:
+            self.balancer.resume()
+        self.observe('bms_sweep_seconds', time.perf_counter() - start)
+        self.sweepRows = rows
+        if not rows:
+            return
 
-        for i in range(10):
-            logging.debug(self.comms.read(modAddr, REG_BAL_CTRL, 1))
-            time.sleep(1)
+        #conversion and pack extremes in one pass over every module read
+        self.pack.update(rows)
+        self.isFaulted = any(module.hasFault() for module in self.modules)
+        self.stats.update(time.monotonic(), self.pack.cellVolt, rows)
+        self.packVolt = float(self.pack.moduleVolt[rows].sum())
+        self.LowCellVolt = float(self.pack.cellVolt[rows].min())
+        self.HighCellVolt = float(self.pack.cellVolt[rows].max())
+        self.lowestPackTemp = min(self.lowestPackTemp, float(self.pack.lowestTemperature[rows].min()))
+        self.highestPackTemp = max(self.highestPackTemp, float(self.pack.highestTemperature[rows].max()))
 
+        #the per module report is only built when someone reads it
+        if logging.root.isEnabledFor(logging.DEBUG):
+            for row in rows:
+                module = self.modules[row]
+                logging.debug('[!] Module voltage: %f' % module.moduleVolt)
+                logging.debug('[!] (since reset) Lowest Cell V: %f\tHighest Cell V: %f' % (min([a for a in module.lowestCellVolt]), max([a for a in module.highestCellVolt])))
+                logging.debug('[!] (current) Cell V: ' + str(['%f ' % a for a in module.cellVolt]))
+                logging.debug('[!] Temp1: %f\t\tTemp2: %f' % (module.temperatures[0], module.temperatures[1]))
 
+        for listener in self.listeners:
+            listener(self)
 
+    def pollFaults(self):
+        #cheap check between sweeps: the fault line if there is one, else the 4 status bytes of every module
+        #modules whose status changed get a full read right away, returns them
+        if not self.connected:
+            self.connect()
+        if self.faultLine is not None:
+            if not self.faultLine():
+                return []
+        elif self.asleep:
+            return []
+        start = time.perf_counter()
+        changed = []
+        for module in self.modules:
+            previous = module.status()
+            if module.readStatus() and module.status() != previous:
+                logging.debug('[!] Module %d status changed to alerts=%X faults=%X COV=%X CUV=%X' % ((module.moduleAddress,) + module.status()))
+                changed.append(module)
+        self.observe('bms_fault_poll_seconds', time.perf_counter() - start)
+        if not changed:
+            return changed
 
-    def readAllVoltTemp(self):
-        self.packVolt = 0.0
-        self.stopBalancing()
-        time.sleep(0.02)
+        #targeted measurement of the modules that changed only
+        if self.balancer.pause():
+            time.sleep(BALANCE_SETTLE)
+        try:
+            for module in changed:
+                module.readVoltTemp()
+        finally:
+            self.balancer.resume()
+        self.isFaulted = any(module.hasFault() for module in self.modules)
+        if self.isFaulted:
+            logging.warning('[-] Pack faulted on modules %s' % [m.moduleAddress for m in self.modules if m.hasFault()])
+        for listener in self.listeners:
+            listener(self)
+        return changed
 
+    def checkModules(self):
+        #health check, one register image read per module diffed against the cached one
+        #returns {address: (changes, reset)} of the modules that drifted or were reset
+        if not self.connected:
+            self.connect()
+        problems = {}
+        silent = []
         for module in self.modules:
-            logging.debug('[!] Module %i || Reading voltage and temperature values' % module.moduleAddress)
-            module.readVoltTemp()
-            logging.debug('[!] Module voltage: %f' % module.moduleVolt)
-            logging.debug('[!] (since reset) Lowest Cell V: %f\tHighest Cell V: %f' % (min([a for a in module.lowestCellVolt]), max([a for a in module.highestCellVolt])))
-            logging.debug('[!] (current) Cell V: ' + str(['%f ' % a for a in module.cellVolt]))
-            logging.debug('[!] Temp1: %f\t\tTemp2: %f' % (module.temperatures[0], module.temperatures[1]))
-            self.packVolt += module.moduleVolt
-            self.lowestPackTemp = min(self.lowestPackTemp, module.lowestTemperature)
-            self.highestPackTemp = max(self.highestPackTemp, module.highestTemperature)
+            result = module.checkImage()
+            if not result:
+                silent.append(module)
+            elif result[0] or result[1]:
+                problems[module.moduleAddress] = result
+                #what we wrote to this module is not what it holds anymore
+                self.comms.invalidateShadow(module.moduleAddress)
+        #a module that lost its address answers at address 0 instead
+        if silent and self.comms.readNoCRC(0, 0, 1)[:3] == [0x80, 0, 1]:
+            for module in silent:
+                logging.warning('[-] Module %d was reset' % module.moduleAddress)
+                problems[module.moduleAddress] = ({}, True)
+        if any(reset for changes, reset in problems.values()):
+            #a reset module is back at address 0, take the chain again from the topology
+            if not self.restoreTopology():
+                self.autoAssignModuleAddresses()
+                self.saveTopology()
+            #the new modules take their reference image on the next check, after a sweep configured them
+            self.clearFaults()
+        return problems
+
+    def close(self):
+        #release the link, a manager is not used after close
+        self.comms.close()
+
+    def observe(self, name, seconds):
+        #duration histogram of this chain, see BMSMetrics
+        if self.comms.metrics is not None:
+            self.comms.metrics.observe(name, (self.comms.name,), seconds)
 
     def stopBalancing(self):
-        self.comms.write(BROADCAST, REG_BAL_CTRL, 0x00)
+        self.manualUntil = 0.0
+        self.balancer.stop()
+
+    def startConversion(self):
+        #same configuration as BMSModule.startConversion but sent once to the whole pack
+        self.comms.write(BROADCAST, REG_ADC_CTRL, 0x3d)
+        self.comms.write(BROADCAST, REG_IO_CTRL, 0x03)
+        self.comms.write(BROADCAST, REG_ADC_CONV, 0x01)
+        time.sleep(ADC_CONV_DELAY)
 
     def sleepBoards(self):
         logging.debug('[!] Putting the board to bed')
-        self.comms.write(BROADCAST, REG_IO_CTL, 0x04)
+        self.stopBalancing()
+        self.comms.write(BROADCAST, REG_IO_CTRL, 0x04)
+        self.asleep = True
         logging.debug('[+] Boards are sound asleep!')
 
     def wakeBoards(self):
         logging.debug('[!] Waking up the boards')
-        self.comms.write(BROADCAST, REG_IO_CTL, 0x00) #clear sleep bit
+        self.comms.write(BROADCAST, REG_IO_CTRL, 0x00) #clear sleep bit
         self.comms.write(BROADCAST, REG_ALERT_STATUS, 0x04) #cause a reset
         self.comms.write(BROADCAST, REG_ALERT_STATUS, 0x00) #clear alert
+        self.asleep = False
+        #the wake up reset changed the registers on purpose
+        for module in self.modules:
+            module.image = None
         logging.debug('[+] Boards are awake!')
 
     def clearFaults(self):
@@ -116,30 +338,108 @@ class BMSModuleManager:
 
     def resetModuleAddresses(self):
         logging.debug('[!] Resetting module addresses')
-        val = None
-        while val != [0x7f, 0x3c, 0xa5, 0x57]:
-            val = self.comms.write(BROADCAST, REG_RESET, 0xA5)
-            time.sleep(0.02)
+        if not retry(lambda: self.comms.write(BROADCAST, REG_RESET, 0xA5), lambda val: val == [0x7f, 0x3c, 0xa5, 0x57], operation='reset'):
+            logging.error('[-] Modules did not acknowledge the reset')
+            return False
         logging.debug('[+] Sucessfully reset module addresses')
+        return True
+
+    def setModuleAddress(self, moduleAddress):
+        #give moduleAddress to the first module still at address 0
+        def check(val):
+            if val and val[:3] == [0x81, REG_ADDR_CTRL, moduleAddress | 0x80]:
+                return True
+            #the reply may have been lost after the module took its address, retrying would give it to the next one
+            val = self.comms.read(moduleAddress, REG_ADDR_CTRL, 1)
+            return bool(val) and val[3] == moduleAddress | 0x80
+        return retry(lambda: self.comms.write(0, REG_ADDR_CTRL, moduleAddress | 0x80), check, operation='address')
 
     def autoAssignModuleAddresses(self):
         self.modules = []
-        self.resetModuleAddresses()
+        if not self.resetModuleAddresses():
+            self.buildPack()
+            return
         logging.debug('[!] Assigning module addresses')
-        for i in range(63):
+        for i in range(MAX_MODULE_ADDR):
             val = self.comms.readNoCRC(0, 0, 1)
             if val[:3] == [0x80, 0, 1]:
                 logging.debug("[!] Board 00 found!")
-                self.modules.append(BMSModule(self.comms))
-                self.modules[i].moduleAddress = i+1
-                val2 = [0,0,0]
-                logging.debug("[!] Setting its address to %d" % self.modules[i].moduleAddress)
-                while val2[:3] != [0x81, REG_ADDR_CTRL, self.modules[i].moduleAddress | 0x80]:
-                    val2 = self.comms.write(0, REG_ADDR_CTRL, self.modules[i].moduleAddress | 0x80)
-                    time.sleep(0.02)
+                module = BMSModule(self.comms)
+                module.moduleAddress = i+1
+                logging.debug("[!] Setting its address to %d" % module.moduleAddress)
+                if not self.setModuleAddress(module.moduleAddress):
+                    logging.error("[-] Module did not take address %d" % module.moduleAddress)
+                    break
+                self.modules.append(module)
             else:
                 break
+        self.buildPack()
+        self.connected = True
         logging.debug('[+] Sucessfully assigned module addresses')
 
+    def buildPack(self):
+        #one row per module in the pack arrays
+        self.pack = PackState(len(self.modules))
+        for i in range(len(self.modules)):
+            self.modules[i].attach(self.pack, i)
+
+    def saveTopology(self):
+        if not self.topologyFile:
+            return
+        topology = {
+            "count": len(self.modules),
+            "modules": [{"address": module.moduleAddress, "IgnoreCell": module.IgnoreCell,
+                         "sensor": module.sensor, "scells": module.scells} for module in self.modules],
+        }
+        try:
+            with open(self.topologyFile, "w") as f:
+                json.dump(topology, f, indent=1)
+        except OSError as e:
+            logging.warning('[-] Could not save topology to %s: %s' % (self.topologyFile, e))
+
+    def restoreTopology(self):
+        #rebuild the modules from the topology file when every known address still answers
+        if not self.topologyFile:
+            return False
+        try:
+            with open(self.topologyFile) as f:
+                topology = json.load(f)
+            entries = topology["modules"]
+        except (OSError, ValueError, KeyError):
+            return False
+        if not entries or len(entries) != topology.get("count"):
+            return False
+
+        for entry in entries:
+            if not self.comms.read(entry["address"], REG_DEV_STATUS, 1):
+                logging.debug('[!] Module %d did not answer, re-enumerating' % entry["address"])
+                return False
+        #a module still at address 0 means one was added or reset
+        if self.comms.readNoCRC(0, 0, 1)[:3] == [0x80, 0, 1]:
+            logging.debug('[!] Found an unaddressed module, re-enumerating')
+            return False
+        #a module answering past the last known address means the file is stale or short
+        nextAddress = max(entry["address"] for entry in entries) + 1
+        if nextAddress <= MAX_MODULE_ADDR and self.comms.read(nextAddress, REG_DEV_STATUS, 1):
+            logging.warning('[-] Module %d is not in %s, re-enumerating' % (nextAddress, self.topologyFile))
+            return False
+
+        self.modules = []
+        for entry in entries:
+            module = BMSModule(self.comms)
+            module.moduleAddress = entry["address"]
+            module.IgnoreCell = entry.get("IgnoreCell", 0)
+            module.sensor = entry.get("sensor", 0)
+            module.scells = entry.get("scells", 0)
+            self.modules.append(module)
+        self.buildPack()
+        self.connected = True
+        logging.debug('[+] Restored %d modules from %s' % (len(self.modules), self.topologyFile))
+        return True
+
 
-bmsmm = BMSModuleManager()
+if __name__ == '__main__':
+    #same as BMSCli.py monitor
+    logging.basicConfig(level=logging.DEBUG)
+    bmsmm = BMSModuleManager()
+    bmsmm.run()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+"""
+Pack wide state stored as contiguous arrays, one row per module
+
+BMSModule instances are views onto their row so the manager can compute
+pack extremes and balancing masks in a single vectorized pass per sweep.
+"""
+
+import numpy as np
+
+from BMSConvert import moduleVolts, cellVolts, temperatures
+
+CELLS_PER_MODULE = 6
+TEMPS_PER_MODULE = 2
+#REG_GPAI block: module voltage, 6 cells, 2 temperatures
+ADC_WORDS = 1 + CELLS_PER_MODULE + TEMPS_PER_MODULE
+
+#weight of each cell in the REG_BAL_CTRL bitmask
+CELL_BITS = 1 << np.arange(CELLS_PER_MODULE)
+
+class PackState:
+
+    def __init__(self, numModules):
+        self.numModules = numModules
+        #REG_GPAI words as read from the modules
+        self.rawAdc = np.zeros((numModules, ADC_WORDS), dtype=np.uint16)
+        self.cellVolt = np.empty((numModules, CELLS_PER_MODULE))
+        self.lowestCellVolt = np.empty((numModules, CELLS_PER_MODULE))
+        self.highestCellVolt = np.empty((numModules, CELLS_PER_MODULE))
+        self.moduleVolt = np.empty(numModules)          #sum of the cells
+        self.moduleVoltAdc = np.empty(numModules)       #measured by the module ADC
+        self.lowestModuleVolt = np.empty(numModules)
+        self.highestModuleVolt = np.empty(numModules)
+        self.temperatures = np.empty((numModules, TEMPS_PER_MODULE))
+        self.lowestTemperature = np.empty(numModules)
+        self.highestTemperature = np.empty(numModules)
+        self.clear()
+
+    def clear(self, rows=slice(None)):
+        self.cellVolt[rows] = np.nan
+        self.lowestCellVolt[rows] = 200.0
+        self.highestCellVolt[rows] = 0.0
+        self.moduleVolt[rows] = 0.0
+        self.moduleVoltAdc[rows] = np.nan
+        self.lowestModuleVolt[rows] = 200.0
+        self.highestModuleVolt[rows] = 0.0
+        self.temperatures[rows] = np.nan
+        self.lowestTemperature[rows] = 200.0
+        self.highestTemperature[rows] = -100.0
+
+    def update(self, rows=slice(None)):
+        #rows is a slice or a list of rows, convert their raw ADC words and update the extremes
+        self.convert(rows)
+        self.updateExtremes(rows)
+
+    def convert(self, rows=slice(None)):
+        raw = self.rawAdc[rows]
+        self.moduleVoltAdc[rows] = moduleVolts(raw[:, 0])
+        self.cellVolt[rows] = cellVolts(raw[:, 1:1 + CELLS_PER_MODULE])
+        self.temperatures[rows] = temperatures(raw[:, 1 + CELLS_PER_MODULE:])
+
+    def updateExtremes(self, rows=slice(None)):
+        #fold the latest readings of rows into the since reset extremes
+        cellVolt = self.cellVolt[rows]
+        self.moduleVolt[rows] = cellVolt.sum(axis=1)
+        self.lowestCellVolt[rows] = np.fmin(self.lowestCellVolt[rows], cellVolt)
+        self.highestCellVolt[rows] = np.fmax(self.highestCellVolt[rows], cellVolt)
+        self.lowestModuleVolt[rows] = np.fmin(self.lowestModuleVolt[rows], self.moduleVoltAdc[rows])
+        self.highestModuleVolt[rows] = np.fmax(self.highestModuleVolt[rows], self.moduleVoltAdc[rows])
+        temperatures = self.temperatures[rows]
+        self.lowestTemperature[rows] = np.fmin(self.lowestTemperature[rows], temperatures.min(axis=1))
+        self.highestTemperature[rows] = np.fmax(self.highestTemperature[rows], temperatures.max(axis=1))
+
+    def lowCellVolt(self):
+        return float(np.nanmin(self.cellVolt))
+
+    def highCellVolt(self):
+        return float(np.nanmax(self.cellVolt))
+
+    def cellDelta(self):
+        return self.highCellVolt() - self.lowCellVolt()
+
+    def balanceMasks(self, tolerance):
+        #REG_BAL_CTRL mask of every module, cells more than tolerance above the lowest cell get bled
+        over = self.cellVolt > (np.nanmin(self.cellVolt) + tolerance)
+        return over.astype(np.uint8) @ CELL_BITS
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+"""
+Pack made of several strings, each one a module chain on its own UART
+
+BMSPackManager owns one BMSModuleManager per serial port, scans them in
+parallel on a thread pool (the time is spent waiting on the UARTs) and
+merges the results into a single pack snapshot tagged with string IDs.
+"""
+
+import logging
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from BMSModuleManager import BMSModuleManager
+
+#one row per module across every string
+PackSnapshot = namedtuple('PackSnapshot', 'timestamp stringIds moduleAddresses cellVolt moduleVolt temperatures faults stringVolt lowCellVolt highCellVolt')
+
+class BMSPackManager:
+
+    def __init__(self, serPorts, topologyFiles=None):
+        #serPorts are device names or serial like objects, one per string
+        if topologyFiles is None:
+            topologyFiles = ['topology%d.json' % n for n in range(len(serPorts))]
+        self.executor = ThreadPoolExecutor(max_workers=len(serPorts), thread_name_prefix='bms-string')
+        #the metrics of every string are labelled with its index
+        self.strings = [BMSModuleManager(serPort, topologyFile, name='string%d' % n)
+                        for n, (serPort, topologyFile) in enumerate(zip(serPorts, topologyFiles))]
+        #strings are connected in parallel too, each one may have to enumerate its chain
+        self.parallel('connect')
+        self.latest = None
+        logging.debug('[+] %d strings with %s modules' % (len(self.strings), [len(s.modules) for s in self.strings]))
+
+    def parallel(self, method, *args):
+        #call method on every string at once, returns the results in string order
+        futures = [self.executor.submit(getattr(string, method), *args) for string in self.strings]
+        return [future.result() for future in futures]
+
+    def readAllVoltTemp(self):
+        self.parallel('readAllVoltTemp')
+        self.latest = self.snapshot()
+        return self.latest
+
+    def balanceCells(self, duration=5):
+        self.parallel('balanceCells', duration)
+
+    def clearFaults(self):
+        self.parallel('clearFaults')
+
+    def snapshot(self):
+        stringIds = []
+        moduleAddresses = []
+        faults = []
+        for stringId, string in enumerate(self.strings):
+            for module in string.modules:
+                stringIds.append(stringId)
+                moduleAddresses.append(module.moduleAddress)
+                faults.append((module.alerts, module.faults, module.COVFaults, module.CUVFaults))
+        cellVolt = np.vstack([string.pack.cellVolt for string in self.strings])
+        return PackSnapshot(
+            timestamp=time.time(),
+            stringIds=np.array(stringIds, dtype=np.uint8),
+            moduleAddresses=np.array(moduleAddresses, dtype=np.uint8),
+            cellVolt=cellVolt,
+            moduleVolt=np.concatenate([string.pack.moduleVolt for string in self.strings]),
+            temperatures=np.vstack([string.pack.temperatures for string in self.strings]),
+            faults=np.array(faults, dtype=np.uint8).reshape(-1, 4),
+            stringVolt=np.array([string.packVolt for string in self.strings]),
+            lowCellVolt=float(np.nanmin(cellVolt)) if cellVolt.size else float('nan'),
+            highCellVolt=float(np.nanmax(cellVolt)) if cellVolt.size else float('nan'),
+        )
+
+    def close(self):
+        self.executor.shutdown()
+        for string in self.strings:
+            string.close()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+"""
+Predictive balancing planner, bleeds every cell for just the time it needs
+
+BMSBalancer.plan bleeds every cell more than a fixed tolerance above the
+lowest one for a fixed time, so the high cells overshoot within a sweep
+and the pack never gets closer than the tolerance. BalancePlanner models
+each bleed resistor instead: after every sweep it compares how far each
+bled cell dropped with the cells that were not bled and learns the V/s
+its resistor removes. Every cell above the lowest one by more than the
+deadband then gets the bleed time that brings it down to it, all cells of
+the pack bleeding at once, each stopping at its own time.
+
+The module temperatures limit the heat: up to softTemp the resistors bleed
+all the time, above it the module is cycled on and off with a duty that
+falls to 0 at maxTemp, and the bleed times are stretched to match.
+
+usage: bmsmm.planner.plan()         after every sweep, bmsmm.balancer.step() does the writes
+       BMSPlanner.py [--modules 8] [--spread 0.1]     benchmark against BMSBalancer.plan
+"""
+
+import argparse
+import logging
+
+import numpy as np
+
+class BalancePlanner:
+
+    def __init__(self, manager, bleedRate=2e-5, deadband=0.005, softTemp=45.0, maxTemp=55.0, learn=0.3,
+                 minBled=5.0, maxDuration=3600):
+        self.manager = manager
+        self.bleedRate = bleedRate          #V/s a bleed resistor is assumed to remove until it is learned
+        self.minRate = bleedRate / 10       #slowest V/s believed, a learned rate never makes a bleed time run away
+        self.deadband = deadband            #V above the lowest cell left alone
+        self.softTemp = softTemp            #degrees C above which the duty is reduced
+        self.maxTemp = maxTemp              #degrees C at which balancing stops
+        self.learn = learn                  #weight of the newest observation of a bleed rate
+        self.minBled = minBled              #seconds of bleeding before a drop is used to learn the rate
+        self.maxDuration = maxDuration      #longest bleed time planned, the next sweep plans again anyway
+        self.rates = None                   #learned V/s of every cell, NaN until observed
+        self.last = None                    #cell voltages of the previous plan
+
+    def duty(self, temperature):
+        #fraction of the time a module at temperature may bleed
+        if not temperature < self.maxTemp:
+            return 0.0
+        if temperature <= self.softTemp:
+            return 1.0
+        return (self.maxTemp - temperature) / (self.maxTemp - self.softTemp)
+
+    def rate(self):
+        #V/s of every cell, the learned rate or the median of the learned ones, never below minRate
+        rates = self.rates
+        known = np.isfinite(rates)
+        default = float(np.median(rates[known])) if known.any() else self.bleedRate
+        return np.maximum(np.where(known, rates, default), self.minRate)
+
+    def observe(self, cellVolt, bled):
+        #learn the bleed rates from the drop since the previous plan, the unbled cells give the pack load
+        if self.rates is None or self.rates.shape != cellVolt.shape:
+            self.rates = np.full(cellVolt.shape, np.nan)
+            return
+        drop = self.last - cellVolt
+        valid = np.isfinite(drop)
+        rest = valid & (bled == 0)
+        load = float(np.median(drop[rest])) if rest.any() else 0.0
+        observed = (drop - load) / np.where(bled > 0, bled, 1.0)
+        #a bled cell that did not drop is noise or a load change, not a dead resistor
+        seen = valid & (bled >= self.minBled) & (observed > 0)
+        if not seen.any():
+            return
+        first = seen & ~np.isfinite(self.rates)
+        self.rates[first] = observed[first]
+        update = seen & ~first
+        self.rates[update] += self.learn * (observed[update] - self.rates[update])
+
+    def plan(self, horizon=None):
+        #bleed times of every cell from the latest sweep, horizon caps them to the next plan
+        manager = self.manager
+        balancer = manager.balancer
+        if not manager.modules:
+            return
+        cellVolt = manager.pack.cellVolt[:len(manager.modules)]
+        bled = np.array([balancer.takeBled(module) for module in manager.modules])
+        self.observe(cellVolt, bled)
+        self.last = cellVolt.copy()
+
+        excess = cellVolt - np.nanmin(cellVolt) - self.deadband
+        need = np.where(np.isfinite(excess) & (excess > 0), excess, 0.0) / self.rate()
+        maxDuration = self.maxDuration if horizon is None else min(self.maxDuration, horizon)
+        temperatures = manager.pack.temperatures[:len(manager.modules)]
+        for module, durations, temps in zip(manager.modules, need, temperatures):
+            duty = self.duty(float(np.nanmax(temps)) if np.isfinite(temps).any() else self.maxTemp)
+            if duty <= 0.0:
+                if durations.any():
+                    logging.warning('[-] Module %d too hot to balance' % module.moduleAddress)
+                durations = np.zeros_like(durations)
+                duty = 1.0
+            else:
+                durations = np.minimum(durations / duty, maxDuration)
+            if durations.any() and logging.root.isEnabledFor(logging.DEBUG):
+                logging.debug('[!] Module %d balancing %s s at duty %.2f', module.moduleAddress,
+                              ' '.join('%.0f' % d for d in durations), duty)
+            balancer.assign(module, durations.tolist(), duty)
+
+def benchmark(numModules=8, spread=0.1, interval=60, limit=6 * 3600, threshold=0.01, hotModule=50.0, seed=1):
+    #converge a simulated pack with BMSBalancer.plan and with BalancePlanner on a simulated clock
+    from BMSSimulator import SimulatedChain
+    from BMSModuleManager import BMSModuleManager
+
+    def run(predictive):
+        now = [0.0]
+        clock = lambda: now[0]
+        chain = SimulatedChain(numModules, seed=seed, noise=0.0005, clock=clock)
+        rng = np.random.RandomState(seed)
+        for module in chain.modules:
+            module.cellVolt = (3.7 + spread * rng.random_sample(6)).tolist()
+        if hotModule is not None:
+            chain.modules[0].temperatures = [hotModule, hotModule - 2.0]
+        bmsmm = BMSModuleManager(chain, topologyFile=None)
+        bmsmm.balancer.clock = clock
+        planner = BalancePlanner(bmsmm)
+        start = (chain.transactions, chain.txBytes + chain.rxBytes)
+        lowest = min(min(module.cellVolt) for module in chain.modules)
+        converged = None
+        while now[0] < limit:
+            bmsmm.readAllVoltTemp()
+            if predictive:
+                planner.plan(2 * interval)
+            else:
+                bmsmm.balancer.plan(2 * interval)
+            delta = max(max(m.cellVolt) for m in chain.modules) - min(min(m.cellVolt) for m in chain.modules)
+            if converged is None and delta <= threshold:
+                converged = now[0]
+            if converged is not None and not bmsmm.balancer.active():
+                break
+            nextSweep = now[0] + interval
+            while now[0] < nextSweep:
+                now[0] = min(nextSweep, max(now[0] + 0.5, bmsmm.balancer.step()))
+        cells = [v for module in chain.modules for v in module.cellVolt]
+        return {
+            "convergedAfter": converged,
+            "finalDelta": max(cells) - min(cells),
+            "overshoot": max(0.0, lowest - min(cells)),
+            "transactions": chain.transactions - start[0],
+            "bytes": chain.txBytes + chain.rxBytes - start[1],
+        }
+
+    return {"fixed": run(False), "predictive": run(True)}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the balancing planners on a simulated pack")
+    parser.add_argument("--modules", type=int, default=8, help="modules in the simulated chain")
+    parser.add_argument("--spread", type=float, default=0.1, help="V between the lowest and highest starting cells")
+    parser.add_argument("--interval", type=float, default=60, help="seconds between sweeps")
+    parser.add_argument("--threshold", type=float, default=0.01, help="cell delta in V that counts as balanced")
+    parser.add_argument("--hot", type=float, default=50.0, help="temperature of the first module, C")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.ERROR)
+    results = benchmark(args.modules, args.spread, args.interval, threshold=args.threshold, hotModule=args.hot)
+    for name, result in results.items():
+        converged = result["convergedAfter"]
+        print('%-10s balanced %s  final delta %.1f mV  overshoot %.1f mV  %6d transactions %7d bytes' % (
+            name, 'after %6.0f s' % converged if converged is not None else 'never       ',
+            result["finalDelta"] * 1e3, result["overshoot"] * 1e3, result["transactions"], result["bytes"]))
+
+if __name__ == "__main__":
+    main()
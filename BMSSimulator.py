@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+"""
+Simulated Tesla BMS daisy chain
+
+SimulatedChain behaves like the serial.Serial object Comms talks to and
+answers with the same wire protocol as a chain of real modules: address
+assignment, reset, ADC conversions, alert/fault/COV/CUV registers and
+balancing with its timeout. It can be handed to Comms in place of a port
+name or served on a pty with servePty().
+
+Noise on the measurements, corrupted CRCs and dropped bytes can be
+injected to exercise the error paths.
+"""
+
+import functools
+import os
+import random
+import threading
+import time
+import tty
+from collections import deque
+
+from BMSUtils import *
+from BMSCrc import genCRC
+from BMSConvert import MODULE_VOLT_LSB, CELL_VOLT_LSB, THERM_CHANNELS, tempFromRaw
+
+@functools.lru_cache(maxsize=1024)
+def rawFromTemp(temperature, offset, divider):
+    #the temperature rises with the raw code, bisect the 14 bit range
+    #cached, every conversion of a module asks again for the same few temperatures
+    low, high = 0, 0x3FFF
+    while low < high:
+        mid = (low + high) // 2
+        if tempFromRaw(mid, offset, divider) < temperature:
+            low = mid + 1
+        else:
+            high = mid
+    return low
+
+class SimulatedModule:
+
+    def __init__(self, cellVolt=None, temperatures=None, bleedRate=0.00005, covThreshold=4.2, cuvThreshold=3.0):
+        self.cellVolt = list(cellVolt) if cellVolt else [3.7] * 6
+        self.temperatures = list(temperatures) if temperatures else [25.0, 25.0]
+        self.bleedRate = bleedRate          #V/s lost by a cell while its bleed resistor is on
+        self.covThreshold = covThreshold
+        self.cuvThreshold = cuvThreshold
+        self.noise = 0.0
+        self.random = random
+        self.reset()
+
+    def reset(self):
+        self.regs = bytearray(REG_IMAGE_SIZE)
+        self.moduleAddress = 0
+        self.regs[REG_ALERT_STATUS] = 0x80  #address not assigned
+        self.regs[REG_FAULT_STATUS] = 0x08  #power on reset
+        self.balanceExpiry = 0.0
+        self.lastUpdate = None
+
+    def asleep(self):
+        return bool(self.regs[REG_IO_CTRL] & 0x04)
+
+    def balanceTime(self):
+        value = self.regs[REG_BAL_TIME]
+        return (value & 0x3F) * (60 if value & 0x80 else 1)
+
+    def update(self, now):
+        #bleed the balanced cells and turn the FETs off once the balance timer expires
+        if self.lastUpdate is None:
+            self.lastUpdate = now
+        mask = self.regs[REG_BAL_CTRL]
+        if mask:
+            end = min(now, self.balanceExpiry)
+            dt = max(0.0, end - self.lastUpdate)
+            for i in range(6):
+                if mask & (1 << i):
+                    self.cellVolt[i] -= self.bleedRate * dt
+            if now >= self.balanceExpiry:
+                self.regs[REG_BAL_CTRL] = 0
+        self.lastUpdate = now
+
+    def convert(self):
+        if self.asleep():
+            return
+        noise = self.noise
+        cells = [v + (self.random.gauss(0.0, noise) if noise else 0.0) for v in self.cellVolt]
+        raws = [min(0x3FFF, max(0, int(round(sum(cells) / MODULE_VOLT_LSB))))]
+        raws += [min(0x3FFF, max(0, int(round(v / CELL_VOLT_LSB)))) for v in cells]
+        raws += [rawFromTemp(t, offset, divider) for t, (offset, divider) in zip(self.temperatures, THERM_CHANNELS)]
+        for i, raw in enumerate(raws):
+            self.regs[REG_GPAI + i * 2] = raw >> 8
+            self.regs[REG_GPAI + i * 2 + 1] = raw & 0xFF
+
+        cov = sum(1 << i for i, v in enumerate(cells) if v > self.covThreshold)
+        cuv = sum(1 << i for i, v in enumerate(cells) if v < self.cuvThreshold)
+        self.regs[REG_COV_FAULT] = cov
+        self.regs[REG_CUV_FAULT] = cuv
+        if cov:
+            self.regs[REG_FAULT_STATUS] |= 0x01
+        if cuv:
+            self.regs[REG_FAULT_STATUS] |= 0x02
+
+    def writeRegister(self, address, value, now):
+        self.update(now)
+        if address == REG_RESET:
+            if value == 0xA5:
+                self.reset()
+        elif address == REG_ADDR_CTRL:
+            if value & 0x80:
+                self.moduleAddress = value & 0x3F
+                self.regs[REG_ADDR_CTRL] = value
+                self.regs[REG_ALERT_STATUS] &= ~0x80
+        elif address == REG_ADC_CONV:
+            if value & 0x01:
+                self.convert()
+        elif address == REG_BAL_CTRL:
+            self.regs[REG_BAL_CTRL] = value & 0x3F
+            self.balanceExpiry = now + self.balanceTime()
+        elif address == REG_ALERT_STATUS and value & 0x04:
+            #forcing the sleep alert wakes the module up with a reset of its registers
+            self.regs[REG_IO_CTRL] = 0
+            self.regs[REG_BAL_CTRL] = 0
+            self.regs[REG_ALERT_STATUS] = value
+        elif address < REG_IMAGE_SIZE:
+            self.regs[address] = value
+
+    def readRegisters(self, address, numBytes, now):
+        self.update(now)
+        data = self.regs[address:address + numBytes]
+        return bytes(data) + bytes(numBytes - len(data))
+
+class SimulatedChain:
+
+    def __init__(self, numModules=1, modules=None, baudrate=612500, latency=0.0, realtime=False,
+                 noise=0.0, crcErrorRate=0.0, dropRate=0.0, seed=None, clock=time.monotonic, timeout=1):
+        self.modules = modules if modules is not None else [SimulatedModule() for i in range(numModules)]
+        self.byteTime = 10.0 / baudrate     #8N1 framing
+        self.latency = latency              #seconds between the end of a request and its reply
+        self.realtime = realtime            #hold replies back for the time they take on the wire
+        self.crcErrorRate = crcErrorRate    #probability that a reply frame gets a flipped bit
+        self.dropRate = dropRate            #probability that a reply byte is lost
+        self.random = random.Random(seed)
+        self.clock = clock
+        self.timeout = timeout
+        self.is_open = True
+        for module in self.modules:
+            module.noise = noise
+            module.random = self.random
+
+        self.txBuffer = bytearray()
+        self.rxQueue = deque()              #(readyAt, byte)
+        self.txBytes = 0
+        self.rxBytes = 0
+        self.transactions = 0
+        self.cpu = 0.0                      #process time spent simulating, see BMSBenchmark.measure
+
+    #serial.Serial interface used by Comms
+    def write(self, data):
+        start = time.process_time()
+        self.txBuffer += data
+        self.txBytes += len(data)
+        while self.txBuffer:
+            frameLen = 4 if self.txBuffer[0] & 0x01 else 3
+            if len(self.txBuffer) < frameLen:
+                break
+            frame = bytes(self.txBuffer[:frameLen])
+            del self.txBuffer[:frameLen]
+            self.__transaction(frame)
+        self.cpu += time.process_time() - start
+        return len(data)
+
+    def read(self, size=1):
+        #like serial.Serial, block until size bytes arrived or the timeout expired
+        start = time.process_time()
+        data = bytearray()
+        deadline = time.monotonic() + (self.timeout or 0)
+        while True:
+            now = self.clock()
+            while self.rxQueue and len(data) < size and self.rxQueue[0][0] <= now:
+                data.append(self.rxQueue.popleft()[1])
+            remaining = deadline - time.monotonic()
+            if len(data) >= size or remaining <= 0:
+                break
+            if self.rxQueue:
+                time.sleep(min(max(self.rxQueue[0][0] - now, 0), remaining))
+            else:
+                #nothing else can arrive before the next request
+                time.sleep(remaining)
+        self.rxBytes += len(data)
+        self.cpu += time.process_time() - start
+        return bytes(data)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def inWaiting(self):
+        now = self.clock()
+        return sum(1 for readyAt, b in self.rxQueue if readyAt <= now)
+
+    @property
+    def in_waiting(self):
+        return self.inWaiting()
+
+    def reset_input_buffer(self):
+        self.rxQueue.clear()
+
+    def flush(self):
+        pass
+
+    def isOpen(self):
+        return self.is_open
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def __transaction(self, frame):
+        self.transactions += 1
+        now = self.clock()
+        reply = self.__process(frame, now)
+        if self.crcErrorRate and self.random.random() < self.crcErrorRate:
+            reply = bytearray(reply)
+            reply[-1] ^= 1 << self.random.randrange(8)
+        readyAt = now + self.latency
+        if self.realtime:
+            readyAt += len(frame) * self.byteTime
+        for b in reply:
+            if self.realtime:
+                readyAt += self.byteTime
+            if self.dropRate and self.random.random() < self.dropRate:
+                continue
+            self.rxQueue.append((readyAt, b))
+
+    def __find(self, moduleAddress):
+        for module in self.modules:
+            if module.moduleAddress == moduleAddress:
+                return module
+        return None
+
+    def __process(self, frame, now):
+        moduleAddress = frame[0] >> 1
+        address = frame[1]
+        if frame[0] & 0x01:
+            if genCRC(frame) != 0:
+                module = self.__find(moduleAddress)
+                if module:
+                    module.regs[REG_FAULT_STATUS] |= 0x04
+                return frame
+            if moduleAddress == BROADCAST:
+                for module in self.modules:
+                    module.writeRegister(address, frame[2], now)
+                return frame
+            module = self.__find(moduleAddress)
+            if module is None:
+                return frame
+            module.writeRegister(address, frame[2], now)
+            reply = bytes([frame[0] | 0x80, address, frame[2]])
+            return reply + bytes([genCRC(reply)])
+
+        module = self.__find(moduleAddress) if moduleAddress != BROADCAST else None
+        if module is None:
+            #nobody answers, the request just travels around the loop
+            return frame
+        reply = bytes([frame[0] | 0x80, address, frame[2]]) + module.readRegisters(address, frame[2], now)
+        return reply + bytes([genCRC(reply)])
+
+    def servePty(self):
+        #expose the chain on a pty, returns the device path to give to Comms
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        self.ptyMaster = master
+        self.ptySlave = slave
+
+        def pump():
+            while self.is_open:
+                try:
+                    data = os.read(master, 64)
+                except OSError:
+                    break
+                self.write(data)
+                while self.rxQueue:
+                    os.write(master, self.read(len(self.rxQueue)))
+
+        self.ptyThread = threading.Thread(target=pump, daemon=True)
+        self.ptyThread.start()
+        return os.ttyname(slave)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+"""
+Streaming per cell statistics fed by every sweep
+
+For every cell CellStats keeps an exponentially weighted mean, variance
+and dV/dt, and the mean, variance and least squares dV/dt of the last
+window sweeps. The window lives in a fixed ring buffer with running sums,
+so a sweep costs the same work and memory after a year as after a minute.
+
+Two behaviours are compared against the rest of the pack with a robust
+z-score (median and MAD over every cell):
+  resistance     under load, the cell moves more than the pack mean when the
+                 pack voltage moves, a sign of higher internal resistance
+  selfDischarge  at rest, the cell loses voltage faster than the others over
+                 the window
+
+usage: bmsmm.stats.outliers() -> [(row, cell, kind, score)]
+"""
+
+import numpy as np
+
+CELLS_PER_MODULE = 6
+
+class CellStats:
+
+    def __init__(self, window=60, alpha=0.05, threshold=4.0, minRate=1e-8, minSensitivity=0.2, minLoad=1e-6):
+        self.window = window                    #sweeps in the sliding window
+        self.alpha = alpha                      #weight of the newest sweep in the exponential averages
+        self.threshold = threshold              #robust z-score above which a cell is an outlier
+        self.minRate = minRate                  #V/s off the pack median before a self discharge counts (~1 mV/day)
+        self.minSensitivity = minSensitivity    #excess response to the pack moves before resistance counts
+        self.minLoad = minLoad                  #V^2 variance of the pack mean steps needed to judge resistance
+        self.numModules = None
+
+    def reset(self, numModules):
+        shape = (numModules, CELLS_PER_MODULE)
+        self.numModules = numModules
+        self.count = 0
+        self.head = 0
+        self.t0 = None
+        self.values = np.full((self.window,) + shape, np.nan)
+        self.times = np.zeros(self.window)
+        #running sums over the window, times relative to t0
+        self.n = np.zeros(shape)
+        self.st = np.zeros(shape)
+        self.stt = np.zeros(shape)
+        self.sv = np.zeros(shape)
+        self.svv = np.zeros(shape)
+        self.stv = np.zeros(shape)
+        #exponentially weighted
+        self.ewMean = np.full(shape, np.nan)
+        self.ewVar = np.zeros(shape)
+        self.ewRate = np.zeros(shape)
+        self.ewCov = np.zeros(shape)            #cell step x pack mean step
+        self.ewLoad = 0.0                       #pack mean step squared
+        self.last = np.full(shape, np.nan)
+        self.lastTime = np.zeros(shape)
+        self.lastMean = np.nan
+
+    def update(self, timestamp, cellVolt, rows=None):
+        #one sweep of cell voltages, rows limits it to the modules actually read
+        x = np.array(cellVolt, dtype=float)
+        if rows is not None:
+            fresh = np.zeros(len(x), dtype=bool)
+            fresh[rows] = True
+            x[~fresh] = np.nan
+        if self.numModules != len(x):
+            self.reset(len(x))
+        if self.t0 is None:
+            self.t0 = timestamp
+        ok = np.isfinite(x)
+        t = timestamp - self.t0
+
+        #slide the window, the oldest sweep leaves the running sums
+        if self.count >= self.window:
+            self.__accumulate(self.values[self.head], self.times[self.head], -1.0)
+        self.values[self.head] = x
+        self.times[self.head] = t
+        self.__accumulate(x, t, 1.0)
+        self.head = (self.head + 1) % self.window
+        self.count += 1
+        if self.count % self.window == 0:
+            #every window sweeps, rebuild the sums from the buffer so rounding never builds up
+            self.__resync()
+
+        a = self.alpha
+        first = ok & ~np.isfinite(self.ewMean)
+        self.ewMean[first] = x[first]
+        delta = np.where(ok, x - self.ewMean, 0.0)
+        self.ewMean += a * delta
+        self.ewVar = np.where(ok, (1 - a) * (self.ewVar + a * delta * delta), self.ewVar)
+
+        stepped = ok & np.isfinite(self.last) & (timestamp > self.lastTime)
+        step = np.where(stepped, x - self.last, 0.0)
+        rate = step / np.where(stepped, timestamp - self.lastTime, 1.0)
+        self.ewRate = np.where(stepped, self.ewRate + a * (rate - self.ewRate), self.ewRate)
+        mean = float(x[ok].mean()) if ok.any() else np.nan
+        if np.isfinite(mean) and np.isfinite(self.lastMean):
+            meanStep = mean - self.lastMean
+            self.ewCov = np.where(stepped, self.ewCov + a * (step * meanStep - self.ewCov), self.ewCov)
+            self.ewLoad += a * (meanStep * meanStep - self.ewLoad)
+        self.lastMean = mean
+        self.last = np.where(ok, x, self.last)
+        self.lastTime = np.where(ok, timestamp, self.lastTime)
+
+    def __accumulate(self, x, t, sign):
+        ok = np.isfinite(x)
+        v = np.where(ok, x, 0.0)
+        tt = np.where(ok, t, 0.0)
+        self.n += sign * ok
+        self.st += sign * tt
+        self.stt += sign * tt * tt
+        self.sv += sign * v
+        self.svv += sign * v * v
+        self.stv += sign * tt * v
+
+    def __resync(self):
+        #move t0 to the oldest sweep kept and sum the buffer again
+        filled = min(self.count, self.window)
+        order = (self.head + np.arange(self.window - filled, self.window)) % self.window
+        shift = self.times[order[0]]
+        self.t0 += shift
+        self.times -= shift
+        for name in ('n', 'st', 'stt', 'sv', 'svv', 'stv'):
+            getattr(self, name)[...] = 0.0
+        for i in order:
+            self.__accumulate(self.values[i], self.times[i], 1.0)
+
+    def windowMean(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sv / self.n
+
+    def windowVariance(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.maximum(self.svv / self.n - (self.sv / self.n) ** 2, 0.0)
+
+    def windowRate(self):
+        #least squares dV/dt over the window in V/s, NaN until a cell has two sweeps
+        with np.errstate(invalid='ignore', divide='ignore'):
+            varT = self.stt - self.st * self.st / self.n
+            return np.where(varT > 0, (self.stv - self.st * self.sv / self.n) / varT, np.nan)
+
+    def sensitivity(self):
+        #how much a cell follows the pack mean steps, 1 for an average cell
+        if self.ewLoad <= 0:
+            return np.full_like(self.ewCov, np.nan)
+        return self.ewCov / self.ewLoad
+
+    def outliers(self):
+        #[(row, cell, kind, robust z-score)] of the cells diverging from the pack
+        if self.numModules is None or min(self.count, self.window) < self.window // 2:
+            return []
+        found = []
+        #under load every cell moves with the current, self discharge only shows at rest
+        if self.ewLoad >= self.minLoad:
+            checks = [('resistance', self.sensitivity(), self.minSensitivity)]
+        else:
+            checks = [('selfDischarge', -self.windowRate(), self.minRate)]
+        for kind, value, minimum in checks:
+            finite = np.isfinite(value)
+            if finite.sum() < 3:
+                continue
+            median = np.median(value[finite])
+            excess = np.where(finite, value - median, 0.0)
+            scale = max(1.4826 * float(np.median(np.abs(excess[finite]))), 1e-12)
+            score = excess / scale
+            for row, cell in zip(*np.nonzero((score > self.threshold) & (excess > minimum))):
+                found.append((int(row), int(cell), kind, float(score[row, cell])))
+        return found
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+"""
+Append-only binary time series of pack sweeps
+
+Every sweep is one fixed-width record: timestamp, modules x 6 cell
+voltages, module voltages, temperatures and the alert/fault/COV/CUV bytes.
+Records go to segment files that are read back through memory mapping,
+so range queries by time and module never parse text. Old segments are
+compacted into per-interval means and dropped after the retention period
+to keep months of 1 Hz data on an SD card.
+
+usage: store = SampleStore('/var/lib/teslabms', numModules)
+       bmsmm.listeners.append(store.recordSweep)
+"""
+
+import logging
+import os
+import struct
+import time
+
+import numpy as np
+
+MAGIC = b'BMSTS1\0\0'
+HEADER = struct.Struct('<8sII')     #magic, number of modules, flags
+HEADER_SIZE = HEADER.size
+FLAG_COMPACTED = 0x01
+
+def recordType(numModules):
+    return np.dtype([
+        ('timestamp', '<f8'),
+        ('cellVolt', '<f4', (numModules, 6)),
+        ('moduleVolt', '<f4', (numModules,)),
+        ('temperatures', '<f4', (numModules, 2)),
+        ('faults', 'u1', (numModules, 4)),
+    ])
+
+class Segment:
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, self.numModules, self.flags = HEADER.unpack(f.read(HEADER_SIZE))
+        if magic != MAGIC:
+            raise ValueError('%s is not a sample segment' % path)
+        self.dtype = recordType(self.numModules)
+        self.start = float(os.path.basename(path).split('-')[1]) / 1e6
+
+    def records(self):
+        #memory mapped view of every complete record in the segment
+        count = (os.path.getsize(self.path) - HEADER_SIZE) // self.dtype.itemsize
+        if count <= 0:
+            return np.empty(0, dtype=self.dtype)
+        return np.memmap(self.path, dtype=self.dtype, mode='r', offset=HEADER_SIZE, shape=(count,))
+
+    def end(self):
+        records = self.records()
+        return float(records['timestamp'][-1]) if len(records) else self.start
+
+class SampleStore:
+
+    def __init__(self, directory, numModules, segmentRecords=3600, retention=None, compactAfter=None, compactInterval=60.0):
+        self.directory = directory
+        self.numModules = numModules
+        self.dtype = recordType(numModules)
+        self.segmentRecords = segmentRecords      #records per segment file before starting a new one
+        self.retention = retention                #seconds of data kept, None keeps everything
+        self.compactAfter = compactAfter          #seconds before full rate segments get compacted
+        self.compactInterval = compactInterval    #seconds averaged into one record when compacting
+        self.record = np.zeros(1, dtype=self.dtype)
+        self.file = None
+        self.fileRecords = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def segments(self):
+        names = sorted(n for n in os.listdir(self.directory) if n.startswith('seg-') and n.endswith('.bms'))
+        return [Segment(os.path.join(self.directory, n)) for n in names]
+
+    def __segmentPath(self, start):
+        return os.path.join(self.directory, 'seg-%016d-%d.bms' % (int(start * 1e6), self.numModules))
+
+    def __newSegment(self, start, flags=0):
+        path = self.__segmentPath(start)
+        f = open(path, 'ab')
+        if f.tell() == 0:
+            f.write(HEADER.pack(MAGIC, self.numModules, flags))
+            f.flush()
+        return f
+
+    def append(self, timestamp, cellVolt, moduleVolt, temperatures, faults):
+        if self.file is None or self.fileRecords >= self.segmentRecords:
+            self.close()
+            self.file = self.__newSegment(timestamp)
+            self.fileRecords = 0
+            self.maintain(timestamp)
+        record = self.record[0]
+        record['timestamp'] = timestamp
+        record['cellVolt'] = cellVolt
+        record['moduleVolt'] = moduleVolt
+        record['temperatures'] = temperatures
+        record['faults'] = faults
+        self.file.write(self.record.tobytes())
+        self.file.flush()
+        self.fileRecords += 1
+
+    def recordSweep(self, manager, timestamp=None):
+        #BMSModuleManager listener, stores the sweep that just completed
+        pack = manager.pack
+        if pack.numModules != self.numModules:
+            logging.warning('[-] Pack has %d modules, store expects %d' % (pack.numModules, self.numModules))
+            return
+        faults = [(m.alerts, m.faults, m.COVFaults, m.CUVFaults) for m in manager.modules]
+        self.append(time.time() if timestamp is None else timestamp, pack.cellVolt, pack.moduleVolt, pack.temperatures, faults)
+
+    def query(self, start=None, end=None, modules=None):
+        #structured array of the records with start <= timestamp < end, modules selects rows (module index, slice or list)
+        parts = []
+        for segment in self.segments():
+            if segment.numModules != self.numModules:
+                continue
+            if end is not None and segment.start >= end:
+                continue
+            records = segment.records()
+            timestamps = records['timestamp']
+            first = 0 if start is None else np.searchsorted(timestamps, start, 'left')
+            last = len(records) if end is None else np.searchsorted(timestamps, end, 'left')
+            if first < last:
+                parts.append(records[first:last])
+        result = np.concatenate(parts) if parts else np.empty(0, dtype=self.dtype)
+        if modules is None:
+            return result
+        #same record layout, narrowed to the selected modules
+        rows = np.atleast_1d(np.arange(self.numModules)[modules])
+        selected = np.empty(len(result), dtype=recordType(len(rows)))
+        selected['timestamp'] = result['timestamp']
+        for field in ('cellVolt', 'moduleVolt', 'temperatures', 'faults'):
+            selected[field] = result[field][:, rows]
+        return selected
+
+    def maintain(self, now=None):
+        #drop segments past the retention period and compact the old full rate ones
+        now = time.time() if now is None else now
+        current = self.file.name if self.file else None
+        for segment in self.segments():
+            if segment.path == current:
+                continue
+            segmentEnd = segment.end()
+            if self.retention is not None and segmentEnd < now - self.retention:
+                logging.debug('[!] Removing expired segment %s' % segment.path)
+                os.remove(segment.path)
+            elif self.compactAfter is not None and segmentEnd < now - self.compactAfter and not segment.flags & FLAG_COMPACTED:
+                self.compact(segment)
+
+    def compact(self, segment):
+        #replace a segment by the mean of every compactInterval bucket, faults are OR'ed
+        records = np.array(segment.records())
+        if len(records):
+            buckets = np.floor(records['timestamp'] / self.compactInterval)
+            edges = np.flatnonzero(np.diff(buckets)) + 1
+            compacted = np.zeros(len(edges) + 1, dtype=segment.dtype)
+            for n, group in enumerate(np.split(records, edges)):
+                compacted[n]['timestamp'] = group['timestamp'][0]
+                for field in ('cellVolt', 'moduleVolt', 'temperatures'):
+                    compacted[n][field] = group[field].mean(axis=0)
+                compacted[n]['faults'] = np.bitwise_or.reduce(group['faults'], axis=0)
+            path = segment.path + '.tmp'
+            with open(path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, segment.numModules, segment.flags | FLAG_COMPACTED))
+                f.write(compacted.tobytes())
+            os.replace(path, segment.path)
+        logging.debug('[+] Compacted %s to %d records' % (segment.path, len(records) and len(compacted)))
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
@@ -14,10 +14,12 @@ and turn on one of the balancing resistors to test
 """
 
 #Import modules
-import serial
 import time
 import logging
-#import crcmod #run "pip install crcmod" to install this
+import struct
+from collections import namedtuple
+from BMSCrc import genCRC, checkFrame
+from BMSMetrics import METRICS
 
 #constants
 REG_DEV_STATUS     = 0
@@ -41,26 +43,125 @@ REG_BAL_TIME       = 0x33
 REG_ADC_CONV       = 0x34
 REG_ADDR_CTRL      = 0x3B
 REG_RESET          = 0x3C
+REG_FUNCTION_CONFIG = 0x40
+REG_IMAGE_SIZE     = 0x4C #registers and EEPROM configuration, see readImage
+
+#REG_ALERT_STATUS and REG_FAULT_STATUS bits that fault the pack
+ALERT_OT1          = 0x01
+ALERT_OT2          = 0x02
+ALERT_TSD          = 0x08
+FAULT_COV          = 0x01
+FAULT_CUV          = 0x02
+FAULT_IFAULT       = 0x20
+PACK_ALERTS        = ALERT_OT1 | ALERT_OT2 | ALERT_TSD
+PACK_FAULTS        = FAULT_COV | FAULT_CUV | FAULT_IFAULT
 
 MAX_MODULE_ADDR    = 0x3E
 BROADCAST = 0x3F
 
+#configuration registers that only change when we write them, see Comms.write
+SHADOW_REGS        = (REG_ADC_CTRL, REG_IO_CTRL, REG_BAL_CTRL, REG_BAL_TIME)
+
+MAX_FRAME          = 0xFF + 4 #3 byte header, up to 0xFF bytes of data and the CRC
+FRAME_TIMEOUT      = 0.05 #seconds to wait for a complete reply frame
+ADC_CONV_DELAY     = 0.001 #seconds for the ADC to convert every channel
+RETRIES            = 6     #attempts for a transaction that must succeed, see retry
+TRANSACTION_OVERHEAD = 67  #bytes, 3 TX + 4 RX framing bytes plus ~1 ms turnaround at 612500 baud
+
 def printh(data):
     print([hex(b) for b in data])
 
 def u16(data):
     return ((data[0] << 8) + data[1])
 
+#register blocks decoded straight from a reply frame, data starts after the 3 byte header
+ADC_BLOCK = struct.Struct('>9H')        #REG_GPAI to REG_TEMPERATURE2
+STATUS_BLOCK = struct.Struct('>4B')     #REG_ALERT_STATUS to REG_CUV_FAULT
+
+#named registers of the REG_IMAGE_SIZE byte image, the ADC results and reserved bytes are only in raw
+IMAGE_FIELDS = (
+    ('deviceStatus', REG_DEV_STATUS), ('alerts', REG_ALERT_STATUS), ('faults', REG_FAULT_STATUS),
+    ('COVFaults', REG_COV_FAULT), ('CUVFaults', REG_CUV_FAULT), ('presultA', 0x24), ('presultB', 0x25),
+    ('adcControl', REG_ADC_CTRL), ('ioControl', REG_IO_CTRL), ('balanceControl', REG_BAL_CTRL),
+    ('balanceTime', REG_BAL_TIME), ('adcConvert', REG_ADC_CONV), ('shadowControl', 0x3A),
+    ('addressControl', REG_ADDR_CTRL), ('functionConfig', REG_FUNCTION_CONFIG), ('ioConfig', 0x41),
+    ('configCOV', 0x42), ('configCOVT', 0x43), ('configUV', 0x44), ('configUVT', 0x45),
+    ('configOT', 0x46), ('configOTT', 0x47), ('user1', 0x48), ('user2', 0x49), ('user3', 0x4A), ('user4', 0x4B),
+)
+RegisterImage = namedtuple('RegisterImage', [name for name, register in IMAGE_FIELDS] + ['raw'])
+#fields that only change when written, a difference is drift or a reset
+#balanceTime is left out, BMSBalancer rewrites it as the watchdog of every armed module
+CONFIG_FIELDS = ('adcControl', 'ioControl', 'addressControl', 'functionConfig', 'ioConfig',
+                 'configCOV', 'configCOVT', 'configUV', 'configUVT', 'configOT', 'configOTT',
+                 'user1', 'user2', 'user3', 'user4')
+
+def retry(fn, check, retries=RETRIES, delay=0.02, backoff=2.0, operation='transaction'):
+    #call fn until check accepts its result, sleeping delay between tries and growing it by backoff
+    for i in range(retries):
+        val = fn()
+        if check(val):
+            return val or True
+        METRICS.inc('bms_retries_total', (operation,))
+        if i < retries - 1:
+            time.sleep(delay)
+            delay *= backoff
+    return False
+
+def planReads(blocks, overhead=TRANSACTION_OVERHEAD):
+    #merge (register, numBytes) blocks into as few reads as possible,
+    #the gap between two blocks is read through when it costs less than another transaction
+    reads = []
+    for start, numBytes in sorted(blocks):
+        if reads and start - (reads[-1][0] + reads[-1][1]) <= overhead:
+            first = reads[-1][0]
+            reads[-1] = (first, max(reads[-1][1], start + numBytes - first))
+        else:
+            reads.append((start, numBytes))
+    return reads
+
+def decodeImage(frame, offset=3):
+    raw = bytes(frame[offset:offset + REG_IMAGE_SIZE])
+    return RegisterImage(*[raw[register] for name, register in IMAGE_FIELDS], raw=raw)
+
+def diffImages(old, new, fields=CONFIG_FIELDS):
+    #{field: (old, new)} of the fields that changed between two register images
+    return {name: (getattr(old, name), getattr(new, name)) for name in fields if getattr(old, name) != getattr(new, name)}
+
+def imageShowsReset(image, moduleAddress):
+    #a module that lost its address or reports a power on reset has every register back to default
+    return image.addressControl != moduleAddress | 0x80 or bool(image.alerts & 0x80) or bool(image.faults & 0x08)
+
 class Comms:
     class __Comms:
-        def __init__(self, serPort):
+        def __init__(self, serPort, frameTimeout, name=None):
             #self.serPort = serPort
-            #open serial port
+            #deadline in seconds for a complete reply frame
+            self.frameTimeout = frameTimeout
+            #last confirmed value of the configuration registers, keyed by (moduleAddress, register)
+            self.shadow = {}
+            self.writesSaved = 0
+            #counters and histograms of every transaction, None turns them off, see BMSMetrics
+            self.metrics = METRICS
+            #link label of the metrics, ie the string of a BMSPackManager
+            self.name = name or (serPort if isinstance(serPort, str) else type(serPort).__name__)
+            self.ownsPort = isinstance(serPort, str)
+            #BMSCapture.Capture recording every transaction, see startCapture
+            self.capture = None
+            #every reply is received into this buffer, see readView
+            self.rxBuffer = bytearray(MAX_FRAME)
+            self.rxView = memoryview(self.rxBuffer)
+            if not isinstance(serPort, str):
+                #already open serial.Serial like object, ie a BMSSimulator.SimulatedChain
+                self.ser = serPort
+                self.ser.timeout = frameTimeout
+                return
+            #open serial port, pyserial is only needed for a real port
+            import serial
             try:
                 self.ser = serial.Serial( # set parameters
                     port=serPort,
                     baudrate=612500,
-                    timeout=1
+                    timeout=frameTimeout
                 )
                 self.ser.isOpen() # try to open port
                 logging.debug("port has been opened")
@@ -78,27 +179,12 @@ class Comms:
         def __str__(self):
             return repr(self) + self.serPort
 
-        def __genCRC(self, data):
-            generator = 0x07
-            crc = 0
-
-            for c in data:
-                crc ^= c
-
-                for i in range(8):
-                    if (crc & 0x80) != 0:
-                        crc = ((crc << 1) ^ generator) & 0xff
-                    else:
-                        crc = (crc << 1) & 0xff
-
-            return crc
-
         def __tx(self, write,data):
             crc=0
             data[0]=data[0]<<1 #shift address for first byte as format is 0bBAAAAAAW, where B=blocking bit, A=address, W=write bit
             if(write): #use CRC if writing
                 data[0]=data[0] | 0x01 #set write bit
-                crc=self.__genCRC(bytearray(data))
+                crc=genCRC(data)
                 data.append(crc)
             #print('transmitting...')
             #print([hex(b) for b in data])
@@ -106,52 +192,139 @@ class Comms:
             #print('transmitted...')
             return crc
 
-        def __sendData(self, write,data):
-            #this fn just writes data and prints the reply
-            crc=self.__tx(write,data)
-            time.sleep(0.1)
-            rxData=[]
-            #print('RX: ',end='')
-            #print('\n')
-            while(self.ser.inWaiting()):
-                rxData.append(ord(self.ser.read()))
-            #print(rxData) #print in dec
-            #print([hex(b) for b in rxData]) #print in hex
-
-            #Check CRC
-            if write == False: #for Reads we need to calculate a CRC to compare
-                crc=self.__genCRC(bytearray(rxData[0:len(rxData)-1]))
-                #print([hex(b) for b in bytearray(rxData[0:len(rxData)-1])])
-            rxCRC=rxData[len(rxData)-1] #last bit in reply is CRC
-            if(rxCRC != crc):
-                logging.debug("CRC FAIL 0x%x, 0x%x" % (rxCRC, crc))
-                return False
-            else:
-        #        print("CRC PASS")
-                return rxData
-
-        def __sendDataNoCRC(self, write,data):
-            #this fn just writes data and prints the reply
-            crc=self.__tx(write,data)
-            time.sleep(0.1)
-            rxData=[]
-            #print('RX: ',end='')
-            #print('\n')
-            while(self.ser.inWaiting()):
-                rxData.append(ord(self.ser.read()))
-            #print(rxData) #print in dec
-            #print([hex(b) for b in rxData]) #print in hex
+        def __rx(self, numBytes):
+            #read the reply in bulk into the reusable buffer, stop as soon as the frame is complete or the deadline expires
+            view = self.rxView
+            received = 0
+            deadline = time.monotonic() + self.frameTimeout
+            while received < numBytes:
+                received += self.ser.readinto(view[received:numBytes]) or 0
+                if time.monotonic() >= deadline:
+                    break
+            return view[:received]
+
+        def __sendData(self, write,data,rxLen):
+            #this fn writes data and waits for a reply of rxLen bytes
+            moduleAddress, address = data[0], data[1]
+            start = time.perf_counter()
+            self.ser.reset_input_buffer() #drop stale bytes from a previous timed out frame
+            self.__tx(write,data)
+            rxData = self.__rx(rxLen)
+            received = len(rxData)
+            error = None
+            if self.capture is not None:
+                self.capture.record(start, time.perf_counter(), bytes(data), rxData)
+
+            if received < rxLen:
+                logging.debug("RX TIMEOUT got %d of %d bytes", received, rxLen)
+                rxData = False
+                error = 'bms_timeouts_total'
+            #Check CRC, last byte in reply is the CRC of the frame
+            elif not checkFrame(rxData):
+                if logging.root.isEnabledFor(logging.DEBUG):
+                    logging.debug("CRC FAIL 0x%x, 0x%x" % (rxData[-1], genCRC(rxData[:-1])))
+                rxData = False
+                error = 'bms_crc_failures_total'
+
+            if self.metrics is not None:
+                self.metrics.transaction(self.name, 'write' if write else 'read', moduleAddress, address,
+                                         len(data), received, time.perf_counter() - start, error)
+            return rxData
+
+        def __sendDataNoCRC(self, write,data,rxLen):
+            #this fn writes data and returns whatever reply arrived before the deadline
+            moduleAddress, address = data[0], data[1]
+            start = time.perf_counter()
+            self.ser.reset_input_buffer()
+            self.__tx(write,data)
+            rxData = self.__rx(rxLen)
+            if self.capture is not None:
+                self.capture.record(start, time.perf_counter(), bytes(data), rxData)
+            rxData = list(rxData)
+            if self.metrics is not None:
+                self.metrics.transaction(self.name, 'readNoCRC', moduleAddress, address,
+                                         len(data), len(rxData), time.perf_counter() - start)
             return rxData
 
 
+        #reply to a read is the 3 byte header, numBytes of data and the CRC
         def read(self, moduleAddress, address, numBytes):
-            return self.__sendData(False, [moduleAddress, address, numBytes])
+            rxData = self.readView(moduleAddress, address, numBytes)
+            return rxData if rxData is False else list(rxData)
+
+        def readView(self, moduleAddress, address, numBytes):
+            #memoryview on the receive buffer, only valid until the next transaction
+            rxData = self.__sendData(False, [moduleAddress, address, numBytes], numBytes + 4)
+            if rxData is False:
+                self.invalidateShadow(moduleAddress)
+            return rxData
+
+        def readImage(self, moduleAddress):
+            #every register and the EEPROM configuration of a module in one transaction
+            rxData = self.readView(moduleAddress, 0, REG_IMAGE_SIZE)
+            return rxData if rxData is False else decodeImage(rxData)
 
         def readNoCRC(self, moduleAddress, address, numBytes):
-            return self.__sendDataNoCRC(False, [moduleAddress, address, numBytes])
+            return self.__sendDataNoCRC(False, [moduleAddress, address, numBytes], numBytes + 4)
 
+        #reply to a write is the echo of the 3 byte frame and its CRC
+        #returns True without touching the bus when the register already holds data
         def write(self, moduleAddress, address, data):
-            return self.__sendData(True, [moduleAddress, address, data])
+            if self.__isShadowed(moduleAddress, address, data):
+                self.writesSaved += 1
+                if self.metrics is not None:
+                    self.metrics.inc('bms_writes_saved_total', (self.name,))
+                return True
+            rxData = self.__sendData(True, [moduleAddress, address, data], 4)
+            self.__updateShadow(moduleAddress, address, data, rxData)
+            return rxData if rxData is False else list(rxData)
+
+        def startCapture(self, path):
+            #record every transaction to path until stopCapture, see BMSCapture
+            from BMSCapture import Capture
+            self.stopCapture()
+            self.capture = Capture(path)
+            return self.capture
+
+        def stopCapture(self):
+            if self.capture is not None:
+                self.capture.close()
+                self.capture = None
+
+        def invalidateShadow(self, moduleAddress=BROADCAST):
+            #forget what we know about a module, BROADCAST forgets every module
+            if moduleAddress == BROADCAST:
+                self.shadow.clear()
+            else:
+                for key in [k for k in self.shadow if k[0] in (moduleAddress, BROADCAST)]:
+                    del self.shadow[key]
+
+        def __isShadowed(self, moduleAddress, address, data):
+            if address not in SHADOW_REGS:
+                return False
+            value = self.shadow.get((BROADCAST, address))
+            if moduleAddress != BROADCAST:
+                value = self.shadow.get((moduleAddress, address), value)
+            return value == data
+
+        def __updateShadow(self, moduleAddress, address, data, rxData):
+            if rxData is False:
+                self.invalidateShadow(moduleAddress)
+            elif address in (REG_RESET, REG_ADDR_CTRL) or (address == REG_ALERT_STATUS and data & 0x04):
+                #reset, address reassignment or wake up, every register is back to its default
+                self.shadow.clear()
+            elif address in SHADOW_REGS:
+                #the balance FETs turn themselves off when REG_BAL_TIME expires so only off is stable
+                stable = address != REG_BAL_CTRL or data == 0
+                if moduleAddress == BROADCAST:
+                    for key in [k for k in self.shadow if k[1] == address]:
+                        del self.shadow[key]
+                elif self.shadow.get((BROADCAST, address)) != data or not stable:
+                    self.shadow.pop((BROADCAST, address), None)
+                if stable:
+                    self.shadow[(moduleAddress, address)] = data
+                else:
+                    self.shadow.pop((moduleAddress, address), None)
 
 
 
@@ -215,14 +388,33 @@ class Comms:
                 for n in [5,7,9,11,13,15]:
                     print(round((rxData[n]*256 + rxData[n+1]) * 6.250 / 16383, 3))#Vcell
 
-    instance = None
-
-    def __init__(self, serPort = "/dev/ttyUSB1"):
+    instance = None     #first link opened
+    instances = {}      #one link per serial port, until close
+
+    def __init__(self, serPort = "/dev/ttyUSB1", frameTimeout = FRAME_TIMEOUT, name = None):
+        #every Comms on the same port shares one link, other ports get their own chain
+        self.key = serPort if isinstance(serPort, str) else id(serPort)
+        if self.key not in Comms.instances:
+            Comms.instances[self.key] = Comms.__Comms(serPort, frameTimeout, name)
+        elif name:
+            Comms.instances[self.key].name = name
+        self.link = Comms.instances[self.key]
         if not Comms.instance:
-            Comms.instance = Comms.__Comms(serPort)
+            Comms.instance = self.link
+
+    def close(self):
+        #release the link of this port, the port itself is only closed when the link opened it
+        link = Comms.instances.pop(self.key, None)
+        if link is None:
+            return
+        link.stopCapture()
+        if link.ownsPort and link.ser:
+            link.ser.close()
+        if Comms.instance is link:
+            Comms.instance = None
 
     def __getattr__(self, name):
-        return getattr(self.instance, name)
+        return getattr(self.link, name)
 #Run main code
 #a = Comms("/dev/ttyUSB1")
 #a.test()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+"""
+HTTP status API served from the manager's latest snapshot
+
+The server never touches the serial bus: the manager publishes a snapshot
+after every sweep and requests are answered from it. /api/events is a
+Server-Sent Events stream pushing only the values that changed since the
+previous sweep, null for the ones that are gone (a cleared outlier, a
+module that dropped off), so any number of browsers can watch the pack without
+adding UART load. Commands are queued for the control loop.
+
+GET  /api/pack                  pack summary
+GET  /api/modules               every module
+GET  /api/modules/<address>     one module
+GET  /api/cells                 flat list of cells
+GET  /api/events                SSE stream, full snapshot first then changes
+GET  /metrics                   link and sweep metrics in Prometheus text format
+POST /api/commands/<command>    queue balance, clearFaults, sleep or wake, JSON body as arguments
+
+usage: web = BMSWebServer(('', 8080), commands)
+       bmsmm.listeners.append(web.publish)
+       web.start()
+"""
+
+import itertools
+import json
+import logging
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from BMSMetrics import METRICS
+
+COMMANDS = ('balance', 'clearFaults', 'sleep', 'wake')
+MISSING = object()
+
+class CommandQueue:
+    #in memory stand in for the BMSDatabase commands table
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.ids = itertools.count(1)
+
+    def queueCommand(self, command, args=None):
+        id = next(self.ids)
+        self.queue.put((id, command, args or {}))
+        return id
+
+    def pollCommands(self):
+        commands = []
+        while True:
+            try:
+                commands.append(self.queue.get_nowait())
+            except queue.Empty:
+                return commands
+
+    def completeCommand(self, id, status='done'):
+        pass
+
+def diffFlat(old, new):
+    #{key: value} turning the flat snapshot old into new, removed keys map to None
+    changes = {key: value for key, value in new.items() if old.get(key, MISSING) != value}
+    for key in old.keys() - new.keys():
+        changes[key] = None
+    return changes
+
+def flatten(value, prefix='', out=None):
+    #{"modules": [{"cellVolt": [3.7]}]} -> {"modules.0.cellVolt.0": 3.7}
+    out = {} if out is None else out
+    if isinstance(value, dict):
+        for key, item in value.items():
+            flatten(item, '%s%s.' % (prefix, key), out)
+    elif isinstance(value, list):
+        for key, item in enumerate(value):
+            flatten(item, '%s%d.' % (prefix, key), out)
+    else:
+        out[prefix[:-1]] = value
+    return out
+
+class BMSWebServer:
+
+    def __init__(self, address=('', 8080), commands=None, metrics=METRICS):
+        self.commands = commands if commands is not None else CommandQueue()
+        self.metrics = metrics
+        self.snapshot = None
+        self.flat = {}
+        self.changes = {}
+        self.sequence = 0
+        self.updated = threading.Condition()
+        self.httpd = ThreadingHTTPServer(address, self.__handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    def publish(self, manager):
+        #BMSModuleManager listener, swaps in the latest snapshot and wakes the event streams
+        snapshot = manager.snapshot()
+        flat = flatten(snapshot)
+        changes = diffFlat(self.flat, flat)
+        with self.updated:
+            self.snapshot = snapshot
+            self.flat = flat
+            self.changes = changes
+            self.sequence += 1
+            self.updated.notify_all()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='bms-web', daemon=True)
+        self.thread.start()
+        logging.debug('[+] Status API listening on %s:%d' % self.httpd.server_address[:2])
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                logging.debug('[web] ' + format % args)
+
+            def sendJson(self, value, status=200):
+                body = json.dumps(value).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                snapshot = server.snapshot
+                path = self.path.split('?')[0].rstrip('/')
+                if path == '/api/events':
+                    return self.events()
+                if path == '/metrics' and server.metrics is not None:
+                    body = server.metrics.render().encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    return self.wfile.write(body)
+                if snapshot is None:
+                    return self.sendJson({"error": "no sweep yet"}, 503)
+                if path == '/api/pack':
+                    self.sendJson({key: value for key, value in snapshot.items() if key != 'modules'})
+                elif path == '/api/modules':
+                    self.sendJson(snapshot['modules'])
+                elif path.startswith('/api/modules/'):
+                    for module in snapshot['modules']:
+                        if str(module['address']) == path.rsplit('/', 1)[1]:
+                            return self.sendJson(module)
+                    self.sendJson({"error": "no such module"}, 404)
+                elif path == '/api/cells':
+                    self.sendJson([{"module": module['address'], "cell": n, "volt": volt}
+                                   for module in snapshot['modules'] for n, volt in enumerate(module['cellVolt'])])
+                else:
+                    self.sendJson({"error": "not found"}, 404)
+
+            def do_POST(self):
+                path = self.path.split('?')[0].rstrip('/')
+                command = path.rsplit('/', 1)[1]
+                if not path.startswith('/api/commands/') or command not in COMMANDS:
+                    return self.sendJson({"error": "unknown command"}, 404)
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    args = json.loads(self.rfile.read(length)) if length else {}
+                    if not isinstance(args, dict):
+                        raise ValueError('arguments must be an object')
+                except ValueError as e:
+                    return self.sendJson({"error": str(e)}, 400)
+                self.sendJson({"id": server.commands.queueCommand(command, args)}, 202)
+
+            def events(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                with server.updated:
+                    sequence = server.sequence
+                    changes = seen = server.flat
+                try:
+                    while True:
+                        if changes:
+                            self.wfile.write(('id: %d\ndata: %s\n\n' % (sequence, json.dumps(changes))).encode())
+                        else:
+                            #keep idle connections alive through proxies
+                            self.wfile.write(b': keepalive\n\n')
+                        self.wfile.flush()
+                        with server.updated:
+                            changes = None
+                            if server.updated.wait_for(lambda: server.sequence != sequence, timeout=15):
+                                #a client that fell behind more than one sweep gets the diff from what it last saw
+                                changes = server.changes if server.sequence == sequence + 1 else diffFlat(seen, server.flat)
+                                sequence = server.sequence
+                                seen = server.flat
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+        return Handler
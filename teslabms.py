@@ -14,7 +14,7 @@ serPort="/dev/ttyUSB1" # on RPI 3b+
 #Import modules
 import serial
 import time
-import crcmod #run "pip install crcmod" to install this
+from BMSCrc import genCRC
 
 def main():
     #Reset all connected modules with a broadcast
@@ -108,7 +108,7 @@ def readADCs(address):
 
 
 #setup CRC
-crc8f=crcmod.mkCrcFun(0x107,initCrc=0,rev=False)
+crc8f=genCRC
 #Define constants
 Write=True
 Read=False
@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+
+#the BMS* modules live flat at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from BMSSimulator import SimulatedChain
+from BMSModuleManager import BMSModuleManager
+from BMSActivity import PackActivity
+
+@pytest.fixture
+def makeManager():
+    #makeManager(numModules, spread, **chainArgs) -> (chain, bmsmm, now), now[0] is the simulated clock
+    managers = []
+    def make(numModules=3, spread=0.0, seed=1, **chainArgs):
+        now = [0.0]
+        clock = lambda: now[0]
+        chain = SimulatedChain(numModules, seed=seed, clock=clock, **chainArgs)
+        for n, module in enumerate(chain.modules):
+            module.cellVolt = [3.7 + spread * n] * 6
+        bmsmm = BMSModuleManager(chain, topologyFile=None)
+        bmsmm.balancer.clock = clock
+        bmsmm.activity = PackActivity(clock=clock, quietPeriod=None)
+        managers.append(bmsmm)
+        return chain, bmsmm, now
+    yield make
+    for bmsmm in managers:
+        bmsmm.close()
@@ -0,0 +1,25 @@
+from BMSActivity import IDLE
+
+def test_failed_reads_do_not_look_like_a_discharge(makeManager):
+    chain, bmsmm, now = makeManager(8, seed=3, crcErrorRate=0.02)
+    failed = 0
+    for i in range(100):
+        bmsmm.readAllVoltTemp()
+        failed += len(bmsmm.sweepRows) < len(bmsmm.modules)
+        assert bmsmm.activity.update(bmsmm) > bmsmm.activity.fastInterval
+        assert bmsmm.activity.state == IDLE
+        now[0] += 30
+    assert failed
+
+def test_cooling_speeds_up_the_sweeps(makeManager):
+    chain, bmsmm, now = makeManager(2, seed=3)
+    for module in chain.modules:
+        module.temperatures = [40.0, 40.0]
+    for i in range(3):
+        bmsmm.readAllVoltTemp()
+        bmsmm.activity.update(bmsmm)
+        now[0] += 60
+    for module in chain.modules:
+        module.temperatures = [30.0, 30.0]
+    bmsmm.readAllVoltTemp()
+    assert bmsmm.activity.update(bmsmm) == bmsmm.activity.fastInterval
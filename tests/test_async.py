@@ -0,0 +1,83 @@
+import asyncio
+import time
+
+import numpy as np
+
+from BMSSimulator import SimulatedChain
+from BMSAsync import SerialProtocol, AsyncComms, AsyncBMSModuleManager
+from BMSUtils import REG_ADDR_CTRL
+
+class ChainWriter:
+    #stands in for the write pipe, the simulated chain answers straight into the protocol
+    def __init__(self, chain, protocol):
+        self.chain = chain
+        self.protocol = protocol
+        self.frames = []
+        self.silent = False
+
+    def write(self, data):
+        self.frames.append(bytes(data))
+        self.chain.write(data)
+        if self.chain.rxQueue:
+            reply = self.chain.read(len(self.chain.rxQueue))
+            if not self.silent:
+                asyncio.get_running_loop().call_soon(self.protocol.data_received, reply)
+
+    def close(self):
+        pass
+
+def openComms(chain, frameTimeout=0.05):
+    protocol = SerialProtocol()
+    comms = AsyncComms(protocol, ChainWriter(chain, protocol), frameTimeout)
+    comms.start()
+    return comms
+
+def addressed(numModules):
+    chain = SimulatedChain(numModules, seed=1)
+    for n, module in enumerate(chain.modules):
+        module.moduleAddress = n + 1
+        module.regs[REG_ADDR_CTRL] = (n + 1) | 0x80
+    return chain
+
+def test_transactions_go_on_the_wire_in_queue_order():
+    async def scenario():
+        comms = openComms(addressed(3))
+        order = [3, 1, 2, 2, 1]
+        replies = await asyncio.gather(*[comms.read(address, REG_ADDR_CTRL, 1) for address in order])
+        await comms.close()
+        return comms.writer.frames, replies, order
+    frames, replies, order = asyncio.run(scenario())
+    assert [frame[0] >> 1 for frame in frames] == order
+    assert [reply[3] & 0x3F for reply in replies] == order
+
+def test_a_timed_out_frame_does_not_leak_into_the_next_one():
+    async def scenario():
+        comms = openComms(addressed(2))
+        comms.writer.silent = True
+        start = time.monotonic()
+        lost = await comms.read(1, REG_ADDR_CTRL, 1, timeout=0.02)
+        elapsed = time.monotonic() - start
+        comms.writer.silent = False
+        reply = await comms.read(2, REG_ADDR_CTRL, 1)
+        await comms.close()
+        return lost, elapsed, reply
+    lost, elapsed, reply = asyncio.run(scenario())
+    assert lost is False
+    assert elapsed < 0.5
+    assert reply[3] == 0x82
+
+def test_async_manager_shares_the_sync_manager_logic():
+    chain = SimulatedChain(3, seed=1)
+    async def scenario():
+        bmsmm = AsyncBMSModuleManager(openComms(chain), topologyFile=None)
+        await bmsmm.setup()
+        await bmsmm.readAllVoltTemp()
+        await bmsmm.readAllVoltTemp()
+        await bmsmm.close()
+        return bmsmm
+    bmsmm = asyncio.run(scenario())
+    assert [module.moduleAddress for module in bmsmm.modules] == [1, 2, 3]
+    expected = np.array([module.cellVolt for module in chain.modules])
+    assert np.allclose(bmsmm.pack.cellVolt[:3], expected, atol=0.01)
+    #the write shadow of the shared Comms link skips the configuration already on the modules
+    assert bmsmm.manager.comms.writesSaved > 0
@@ -0,0 +1,35 @@
+from BMSSimulator import SimulatedChain
+from BMSModuleManager import BMSModuleManager
+from BMSCapture import CaptureReader, ReplaySerial
+from BMSUtils import Comms
+
+def test_replay_matches_the_recording(tmp_path):
+    path = str(tmp_path / 'chain.bmscap')
+    chain = SimulatedChain(4, seed=2, noise=0.001)
+    comms = Comms(chain)
+    comms.startCapture(path)
+    bmsmm = BMSModuleManager(chain, topologyFile=None)
+    for i in range(20):
+        bmsmm.readAllVoltTemp()
+    recorded = bmsmm.pack.cellVolt.copy()
+    comms.stopCapture()
+
+    replay = ReplaySerial(path, lookahead=16)
+    replayed = BMSModuleManager(replay, topologyFile=None)
+    for i in range(20):
+        replayed.readAllVoltTemp()
+        assert len(replay.pending) <= replay.lookahead
+    assert (replayed.pack.cellVolt == recorded).all()
+    assert replay.missed == 0
+
+def test_capture_is_flushed_while_recording(tmp_path):
+    path = str(tmp_path / 'chain.bmscap')
+    chain = SimulatedChain(2, seed=2)
+    comms = Comms(chain)
+    capture = comms.startCapture(path)
+    capture.flushInterval = 0.0
+    bmsmm = BMSModuleManager(chain, topologyFile=None)
+    bmsmm.readAllVoltTemp()
+    #read while still recording, as after a crash
+    assert sum(1 for record in CaptureReader(path)) == capture.records
+    comms.stopCapture()
@@ -0,0 +1,24 @@
+import os
+
+import BMSCli
+from BMSModuleManager import BMSModuleManager
+from BMSSimulator import SimulatedChain
+
+def test_manager_is_lazy():
+    chain = SimulatedChain(2)
+    bmsmm = BMSModuleManager(chain, topologyFile=None)
+    assert chain.transactions == 0 and not bmsmm.connected
+    bmsmm.readAllVoltTemp()
+    assert bmsmm.connected and len(bmsmm.modules) == 2
+
+def test_scan_enumerates_once(monkeypatch, tmp_path, capsys):
+    monkeypatch.chdir(tmp_path)
+    enumerations = []
+    autoAssign = BMSModuleManager.autoAssignModuleAddresses
+    monkeypatch.setattr(BMSModuleManager, 'autoAssignModuleAddresses',
+                        lambda self: enumerations.append(1) or autoAssign(self))
+    BMSCli.main(['--simulate', '3', 'scan'])
+    assert enumerations == [1]
+    assert '3 modules found' in capsys.readouterr().out
+    #the simulated chain never writes the topology of the real one
+    assert not os.path.exists('topology.json')
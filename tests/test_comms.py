@@ -0,0 +1,53 @@
+import time
+
+from BMSSimulator import SimulatedChain
+from BMSMetrics import Metrics
+from BMSUtils import Comms, REG_ADDR_CTRL, REG_GPAI
+
+def openChain(numModules=2, frameTimeout=0.05, **chainArgs):
+    chain = SimulatedChain(numModules, seed=1, **chainArgs)
+    for n, module in enumerate(chain.modules):
+        module.moduleAddress = n + 1
+        module.regs[REG_ADDR_CTRL] = (n + 1) | 0x80
+    comms = Comms(chain, frameTimeout)
+    comms.link.metrics = Metrics()
+    return chain, comms
+
+def test_complete_frame_returns_without_waiting_for_the_deadline():
+    chain, comms = openChain(frameTimeout=1.0)
+    try:
+        start = time.monotonic()
+        for i in range(20):
+            reply = comms.read(1, REG_GPAI, 0x11)
+        elapsed = time.monotonic() - start
+    finally:
+        comms.close()
+    #3 byte header, 17 bytes of data and the CRC
+    assert len(reply) == 0x11 + 4
+    assert elapsed < 0.5
+
+def test_missing_module_times_out_at_the_frame_deadline():
+    chain, comms = openChain(frameTimeout=0.05)
+    try:
+        start = time.monotonic()
+        reply = comms.read(9, REG_ADDR_CTRL, 1)
+        elapsed = time.monotonic() - start
+        metrics = comms.metrics
+    finally:
+        comms.close()
+    assert reply is False
+    assert 0.04 <= elapsed < 0.5
+    assert metrics.get('bms_timeouts_total', (comms.name, 9)) == 1
+
+def test_truncated_reply_fails_and_does_not_leak_into_the_next_frame():
+    chain, comms = openChain(frameTimeout=0.05)
+    try:
+        chain.dropRate = 0.5
+        chain.random.seed(3)
+        replies = [comms.read(1, REG_ADDR_CTRL, 1) for i in range(5)]
+        chain.dropRate = 0.0
+        reply = comms.read(2, REG_ADDR_CTRL, 1)
+    finally:
+        comms.close()
+    assert False in replies
+    assert reply[:4] == [(2 << 1) | 0x80, REG_ADDR_CTRL, 1, 0x82]
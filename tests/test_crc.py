@@ -0,0 +1,35 @@
+import random
+
+from BMSCrc import genCRC, genCRCBitwise, checkFrame, checkFrames, CRC_TABLE
+
+def test_table_matches_the_bitwise_crc():
+    rng = random.Random(1)
+    assert len(CRC_TABLE) == 256
+    for length in range(0, 40):
+        data = bytes(rng.randrange(256) for i in range(length))
+        assert genCRC(data) == genCRCBitwise(data)
+
+def test_crc_accepts_every_buffer_type():
+    data = [0x02, 0x30, 0x3d]
+    crc = genCRCBitwise(data)
+    for buffer in (data, bytes(data), bytearray(data), memoryview(bytes(data))):
+        assert genCRC(buffer) == crc
+
+def test_frame_check_catches_every_single_bit_flip():
+    payload = bytes([0x82, 0x01, 0x02, 0x12, 0x34])
+    frame = payload + bytes([genCRC(payload)])
+    assert checkFrame(frame)
+    for i in range(len(frame) * 8):
+        bad = bytearray(frame)
+        bad[i // 8] ^= 1 << (i % 8)
+        assert not checkFrame(bad)
+    assert not checkFrame(b'\x00')
+
+def test_batch_check_returns_the_failed_frames():
+    frames = []
+    for n in range(6):
+        payload = bytes([0x02, 0x30, n])
+        frames.append(payload + bytes([genCRC(payload)]))
+    frames[2] = frames[2][:-1] + bytes([frames[2][-1] ^ 0x10])
+    frames[4] = b'\x00'
+    assert checkFrames(frames) == [2, 4]
@@ -0,0 +1,48 @@
+from types import SimpleNamespace
+
+import pytest
+
+from BMSDatabase import BMSDatabase
+
+def sweep(volts):
+    #stand in for a manager, one module per list of cell voltages
+    return SimpleNamespace(modules=[SimpleNamespace(moduleAddress=n + 1, cellVolt=cells, moduleVolt=sum(cells),
+                                                    temperatures=[25.0, 26.0], alerts=0, faults=0, COVFaults=0, CUVFaults=0)
+                                    for n, cells in enumerate(volts)])
+
+@pytest.fixture
+def db(tmp_path):
+    db = BMSDatabase(str(tmp_path / 'bms.db'), flushInterval=0.01)
+    yield db
+    db.close()
+
+def test_rollups(db):
+    for n in range(120):
+        db.recordSweep(sweep([[3.70 + 0.001 * (n % 60)] * 6, [3.80] * 6]), timestamp=6000.0 + n)
+    db.flush()
+    minutes = [row for row in db.rollups('1m', module=1) if row[2] == 0]
+    assert [row[0] for row in minutes] == [6000, 6060]
+    bucket, module, cell, low, high, mean = minutes[0]
+    assert (low, high) == pytest.approx((3.70, 3.759))
+    assert mean == pytest.approx(3.7295)
+    hours = db.rollups('1h', module=2)
+    assert len(hours) == 6 and hours[0][3:] == pytest.approx((3.8, 3.8, 3.8))
+    with pytest.raises(ValueError):
+        db.rollups('1d')
+
+def test_raw_samples_are_pruned(db):
+    db.retention = 3600
+    db.pruneInterval = 0
+    db.recordSweep(sweep([[3.7] * 6]), timestamp=1000.0)
+    db.flush()
+    db.recordSweep(sweep([[3.7] * 6]), timestamp=1000.0 + 7200)
+    db.flush()
+    assert [ts for ts, module, cell, volt in db.cellSamples(0, 10 ** 6)][:1] == [8200.0]
+    #the rollups keep the pruned hour
+    assert [row[0] for row in db.rollups('1h', module=1) if row[2] == 0] == [0, 7200]
+
+def test_commands(db):
+    id = db.queueCommand('balance', {'duration': 30, 'command': 'x'})
+    assert db.pollCommands() == [(id, 'balance', {'duration': 30, 'command': 'x'})]
+    db.completeCommand(id, 'done')
+    assert db.pollCommands() == []
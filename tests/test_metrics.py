@@ -0,0 +1,50 @@
+from BMSMetrics import Metrics, LATENCY_BUCKETS
+
+def lines(metrics):
+    return metrics.render().splitlines()
+
+def test_transactions_render_as_counters_and_histograms():
+    metrics = Metrics()
+    metrics.transaction('string0', 'read', 1, 0x01, 3, 21, 0.0004)
+    metrics.transaction('string0', 'read', 1, 0x01, 3, 21, 0.003)
+    metrics.transaction('string0', 'read', 2, 0x01, 3, 0, 0.05, 'bms_timeouts_total')
+    text = lines(metrics)
+    assert '# TYPE bms_transactions_total counter' in text
+    assert 'bms_transactions_total{link="string0",type="read",module="1",register="1"} 2' in text
+    assert 'bms_tx_bytes_total{link="string0"} 9' in text
+    assert 'bms_rx_bytes_total{link="string0"} 42' in text
+    assert 'bms_timeouts_total{link="string0",module="2"} 1' in text
+    assert '# TYPE bms_transaction_seconds histogram' in text
+    prefix = 'bms_transaction_seconds_bucket{link="string0",type="read",module="1",register="1",le='
+    buckets = [line for line in text if line.startswith(prefix)]
+    assert len(buckets) == len(LATENCY_BUCKETS) + 1
+    assert buckets[0].endswith('"0.00025"} 0')
+    assert buckets[1].endswith('"0.0005"} 1')
+    assert buckets[-1] == prefix + '"+Inf"} 2'
+    assert 'bms_transaction_seconds_count{link="string0",type="read",module="1",register="1"} 2' in text
+
+def test_every_series_has_its_help_and_type_once():
+    metrics = Metrics()
+    metrics.inc('bms_retries_total', ('reset',))
+    metrics.inc('bms_retries_total', ('address',), 3)
+    metrics.observe('bms_sweep_seconds', ('string1',), 0.2)
+    text = lines(metrics)
+    assert text.count('# TYPE bms_retries_total counter') == 1
+    assert 'bms_retries_total{operation="address"} 3' in text
+    assert 'bms_sweep_seconds_sum{link="string1"} 0.2' in text
+    #nothing recorded, nothing rendered
+    assert not any('bms_crc_failures_total' in line for line in text)
+
+def test_label_values_are_escaped():
+    metrics = Metrics()
+    metrics.inc('bms_writes_saved_total', ('C:\\port "1"',))
+    assert 'bms_writes_saved_total{link="C:\\\\port \\"1\\""} 1' in lines(metrics)
+
+def test_write_file_replaces_the_whole_file(tmp_path):
+    metrics = Metrics()
+    metrics.inc('bms_writes_saved_total', ('string0',), 5)
+    path = str(tmp_path / 'bms.prom')
+    metrics.writeFile(path)
+    with open(path) as f:
+        assert f.read() == metrics.render()
+    assert not (tmp_path / 'bms.prom.tmp').exists()
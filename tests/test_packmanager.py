@@ -0,0 +1,42 @@
+import numpy as np
+
+from BMSSimulator import SimulatedChain
+from BMSPackManager import BMSPackManager
+from BMSMetrics import Metrics
+from BMSUtils import Comms
+
+def makePack(sizes=(2, 3)):
+    chains = [SimulatedChain(n, seed=n) for n in sizes]
+    return chains, BMSPackManager(chains, topologyFiles=[None] * len(chains))
+
+def test_snapshot_tags_every_module_with_its_string():
+    chains, pack = makePack()
+    try:
+        snapshot = pack.readAllVoltTemp()
+    finally:
+        pack.close()
+    assert snapshot.stringIds.tolist() == [0, 0, 1, 1, 1]
+    assert snapshot.moduleAddresses.tolist() == [1, 2, 1, 2, 3]
+    assert snapshot.cellVolt.shape == (5, 6)
+    expected = [v for chain in chains for module in chain.modules for v in module.cellVolt]
+    assert np.allclose(snapshot.cellVolt.ravel(), expected, atol=0.01)
+    assert len(snapshot.stringVolt) == 2
+
+def test_metrics_are_labelled_per_string():
+    chains, pack = makePack()
+    metrics = Metrics()
+    try:
+        for string in pack.strings:
+            string.comms.link.metrics = metrics
+        pack.readAllVoltTemp()
+    finally:
+        pack.close()
+    links = set(labels[0] for (name, labels) in metrics.counters if name == 'bms_transactions_total')
+    assert links == {'string0', 'string1'}
+
+def test_close_releases_the_links():
+    chains, pack = makePack()
+    keys = [string.comms.key for string in pack.strings]
+    assert all(key in Comms.instances for key in keys)
+    pack.close()
+    assert not any(key in Comms.instances for key in keys)
@@ -0,0 +1,58 @@
+import warnings
+
+import numpy as np
+
+from BMSPlanner import BalancePlanner, benchmark
+from BMSUtils import REG_BAL_CTRL
+from BMSWeb import CommandQueue
+
+def test_stuck_cell_does_not_bleed_for_the_horizon(makeManager):
+    chain, bmsmm, now = makeManager(2, spread=0.1)
+    planner = bmsmm.planner
+    bmsmm.readAllVoltTemp()
+    planner.plan(120)
+    bmsmm.balancer.step()
+    #the bled cells do not drop at all
+    for module in chain.modules:
+        module.bleedRate = 0.0
+    now[0] = 60
+    bmsmm.readAllVoltTemp()
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        planner.plan()
+    assert np.all(planner.rate() >= planner.minRate)
+    assert all(np.isfinite(state.expiry()) for state in bmsmm.balancer.states.values())
+
+def test_hot_module_is_cycled():
+    planner = BalancePlanner(None)
+    assert planner.duty(25.0) == 1.0
+    assert planner.duty(50.0) == 0.5
+    assert planner.duty(60.0) == 0.0
+
+def test_predictive_beats_fixed():
+    results = benchmark(numModules=4, limit=3 * 3600)
+    assert results["fixed"]["convergedAfter"] is None
+    assert results["predictive"]["convergedAfter"] is not None
+    assert results["predictive"]["overshoot"] < 0.002
+
+def test_balance_command_is_not_replanned(makeManager):
+    chain, bmsmm, now = makeManager(spread=0.1)
+    commands = CommandQueue()
+    commands.queueCommand('balance', {'duration': 600})
+    bmsmm.sweep(60, commands)
+    now[0] = 60
+    bmsmm.sweep(60, commands)
+    assert [state.expiry() for state in bmsmm.balancer.states.values()] == [0.0, 600.0, 600.0]
+
+def test_sleeping_boards_are_not_rearmed(makeManager):
+    chain, bmsmm, now = makeManager(spread=0.1)
+    bmsmm.sweep(60)
+    assert bmsmm.balancer.active()
+    commands = CommandQueue()
+    commands.queueCommand('sleep')
+    now[0] = 60
+    bmsmm.sweep(60, commands)
+    bmsmm.balancer.step()
+    assert bmsmm.asleep
+    assert not bmsmm.balancer.active()
+    assert not any(module.regs[REG_BAL_CTRL] for module in chain.modules)
@@ -0,0 +1,22 @@
+from BMSUtils import REG_BAL_CTRL
+
+def test_configuration_drift_and_reset(makeManager):
+    chain, bmsmm, now = makeManager(4)
+    bmsmm.readAllVoltTemp()
+    #the first check takes the reference images
+    assert bmsmm.checkModules() == {}
+    chain.modules[1].regs[0x42] = 0x55
+    assert bmsmm.checkModules() == {2: ({'configCOV': (0, 0x55)}, False)}
+    chain.modules[2].reset()
+    assert bmsmm.checkModules()[3] == ({}, True)
+    #the reset module was given its address back
+    assert [module.moduleAddress for module in chain.modules] == [1, 2, 3, 4]
+
+def test_balancing_is_not_drift(makeManager):
+    chain, bmsmm, now = makeManager(spread=0.1)
+    bmsmm.readAllVoltTemp()
+    assert bmsmm.checkModules() == {}
+    bmsmm.planner.plan()
+    bmsmm.balancer.step()
+    assert any(module.regs[REG_BAL_CTRL] for module in chain.modules)
+    assert bmsmm.checkModules() == {}
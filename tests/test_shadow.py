@@ -0,0 +1,61 @@
+from BMSSimulator import SimulatedChain
+from BMSUtils import Comms, BROADCAST, REG_ADC_CTRL, REG_IO_CTRL, REG_RESET, REG_ADDR_CTRL, REG_ALERT_STATUS
+
+def openChain(numModules=2):
+    chain = SimulatedChain(numModules, seed=1)
+    for n, module in enumerate(chain.modules):
+        module.moduleAddress = n + 1
+    return chain, Comms(chain, 0.02)
+
+def test_repeated_configuration_writes_stay_off_the_bus():
+    chain, comms = openChain()
+    try:
+        assert comms.write(BROADCAST, REG_ADC_CTRL, 0x3d)
+        sent = chain.transactions
+        assert comms.write(BROADCAST, REG_ADC_CTRL, 0x3d) is True
+        assert comms.write(1, REG_ADC_CTRL, 0x3d) is True
+        assert chain.transactions == sent
+        assert comms.writesSaved == 2
+        #another value goes out and becomes the one shadowed
+        comms.write(1, REG_ADC_CTRL, 0x3c)
+        assert chain.transactions == sent + 1
+    finally:
+        comms.close()
+
+def test_reset_wake_and_address_change_forget_the_shadow():
+    chain, comms = openChain()
+    try:
+        for invalidate in ((BROADCAST, REG_RESET, 0xA5), (0, REG_ADDR_CTRL, 0x81), (BROADCAST, REG_ALERT_STATUS, 0x04)):
+            comms.write(BROADCAST, REG_IO_CTRL, 0x03)
+            assert comms.shadow
+            comms.write(*invalidate)
+            assert not comms.shadow, invalidate
+            sent = chain.transactions
+            comms.write(BROADCAST, REG_IO_CTRL, 0x03)
+            assert chain.transactions == sent + 1
+    finally:
+        comms.close()
+
+def test_failed_reply_forgets_only_that_module():
+    chain, comms = openChain()
+    try:
+        comms.write(1, REG_IO_CTRL, 0x03)
+        comms.write(2, REG_IO_CTRL, 0x03)
+        chain.dropRate = 1.0
+        assert comms.read(1, REG_IO_CTRL, 1) is False
+        chain.dropRate = 0.0
+        assert (1, REG_IO_CTRL) not in comms.shadow
+        assert comms.shadow[(2, REG_IO_CTRL)] == 0x03
+    finally:
+        comms.close()
+
+def test_drifted_module_gets_its_configuration_again(makeManager):
+    chain, bmsmm, now = makeManager(3)
+    bmsmm.connect()
+    bmsmm.readAllVoltTemp()
+    bmsmm.checkModules()
+    bmsmm.readAllVoltTemp()
+    chain.modules[1].regs[REG_ADC_CTRL] = 0
+    assert 2 in bmsmm.checkModules()
+    bmsmm.readAllVoltTemp()
+    assert chain.modules[1].regs[REG_ADC_CTRL] == 0x3d
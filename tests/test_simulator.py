@@ -0,0 +1,30 @@
+import pytest
+
+from BMSUtils import REG_BAL_CTRL, REG_BAL_TIME
+
+def test_chain_is_enumerated_and_read(makeManager):
+    chain, bmsmm, now = makeManager(5, spread=0.01)
+    chain.modules[2].temperatures = [31.0, 33.0]
+    bmsmm.readAllVoltTemp()
+    assert [module.moduleAddress for module in bmsmm.modules] == [1, 2, 3, 4, 5]
+    assert bmsmm.pack.cellVolt[:, 0].tolist() == pytest.approx([3.70, 3.71, 3.72, 3.73, 3.74], abs=0.001)
+    assert bmsmm.pack.temperatures[2].tolist() == pytest.approx([31.0, 33.0], abs=0.2)
+
+def test_balance_timer_bleeds_and_expires(makeManager):
+    chain, bmsmm, now = makeManager(1)
+    bmsmm.connect()
+    module = chain.modules[0]
+    bmsmm.comms.write(1, REG_BAL_TIME, 10)
+    bmsmm.comms.write(1, REG_BAL_CTRL, 0x01)
+    now[0] = 20.0
+    assert bmsmm.comms.read(1, REG_BAL_CTRL, 1)[3] == 0
+    #bled for the 10 s of the timer only
+    assert module.cellVolt[0] == pytest.approx(3.7 - 10 * module.bleedRate)
+    assert module.cellVolt[1] == 3.7
+
+def test_corrupted_replies_are_rejected(makeManager):
+    chain, bmsmm, now = makeManager(2)
+    bmsmm.readAllVoltTemp()
+    assert bmsmm.comms.read(1, REG_BAL_CTRL, 1)
+    chain.crcErrorRate = 1.0
+    assert not bmsmm.comms.read(1, REG_BAL_CTRL, 1)
@@ -0,0 +1,56 @@
+import numpy as np
+
+from BMSStats import CellStats
+
+def test_window_statistics_match_the_last_sweeps():
+    rng = np.random.RandomState(1)
+    stats = CellStats(window=20)
+    times = np.arange(75) * 10.0 + 1000.0
+    sweeps = 3.7 + 0.001 * rng.standard_normal((75, 2, 6)) - 1e-5 * times[:, None, None]
+    for t, cellVolt in zip(times, sweeps):
+        stats.update(t, cellVolt)
+    last, lastTimes = sweeps[-20:], times[-20:]
+    assert np.allclose(stats.windowMean(), last.mean(axis=0))
+    assert np.allclose(stats.windowVariance(), last.var(axis=0), atol=1e-12)
+    slope = np.polyfit(lastTimes, last.reshape(20, -1), 1)[0].reshape(2, 6)
+    assert np.allclose(stats.windowRate(), slope, rtol=1e-6)
+    #the ring buffer does not grow with the sweeps
+    assert stats.values.shape == (20, 2, 6)
+
+def test_cells_not_read_in_a_sweep_are_left_out():
+    stats = CellStats(window=10)
+    for t in range(10):
+        stats.update(t, np.full((2, 6), 3.7 + 0.001 * t), rows=[0] if t % 2 else None)
+    assert np.all(stats.n[0] == 10)
+    assert np.all(stats.n[1] == 5)
+    assert np.allclose(stats.windowMean()[1], 3.7 + 0.001 * np.mean([0, 2, 4, 6, 8]))
+
+def test_fast_self_discharge_is_flagged_at_rest():
+    rng = np.random.RandomState(2)
+    stats = CellStats(window=30)
+    for n in range(30):
+        t = n * 600.0
+        cellVolt = 3.7 + 0.00002 * rng.standard_normal((3, 6))
+        cellVolt[1, 4] -= 2e-7 * t      #about 17 mV/day
+        stats.update(t, cellVolt)
+    found = stats.outliers()
+    assert [(row, cell, kind) for row, cell, kind, score in found] == [(1, 4, 'selfDischarge')]
+
+def test_high_resistance_cell_is_flagged_under_load():
+    rng = np.random.RandomState(3)
+    stats = CellStats(window=30)
+    for n in range(60):
+        current = 50.0 * np.sin(n / 3.0)
+        sag = 0.001 * current * (1.0 + 0.05 * rng.standard_normal((3, 6)))
+        sag[2, 1] *= 2.0
+        stats.update(n * 2.0, 3.7 - sag)
+    found = stats.outliers()
+    assert [(row, cell, kind) for row, cell, kind, score in found] == [(2, 1, 'resistance')]
+
+def test_no_verdict_before_half_a_window():
+    stats = CellStats(window=30)
+    for n in range(10):
+        cellVolt = np.full((3, 6), 3.7)
+        cellVolt[0, 0] -= 0.01 * n
+        stats.update(n * 600.0, cellVolt)
+    assert stats.outliers() == []
@@ -0,0 +1,43 @@
+import numpy as np
+
+from BMSStore import SampleStore
+
+def fill(store, start, count, step=1.0):
+    for n in range(count):
+        cells = np.full((store.numModules, 6), 3.7 + 0.001 * n)
+        store.append(start + n * step, cells, cells.sum(axis=1), np.full((store.numModules, 2), 25.0),
+                     np.zeros((store.numModules, 4), dtype=np.uint8))
+
+def test_round_trip(tmp_path):
+    store = SampleStore(str(tmp_path), 3, segmentRecords=10)
+    fill(store, 1000.0, 25)
+    records = store.query()
+    assert len(records) == 25
+    assert len(store.segments()) == 3
+    assert records['timestamp'][0] == 1000.0
+    assert np.allclose(records['cellVolt'][24], 3.724)
+    window = store.query(1005.0, 1015.0)
+    assert window['timestamp'].tolist() == [1005.0 + n for n in range(10)]
+
+def test_module_selection_keeps_the_record_layout(tmp_path):
+    store = SampleStore(str(tmp_path), 3)
+    fill(store, 1000.0, 5)
+    every = store.query()
+    one = store.query(modules=1)
+    assert isinstance(one, np.ndarray) and one.dtype.names == every.dtype.names
+    assert one['cellVolt'].shape == (5, 1, 6)
+    assert store.query(modules=[0, 2])['temperatures'].shape == (5, 2, 2)
+
+def test_retention_and_compaction(tmp_path):
+    store = SampleStore(str(tmp_path), 2, segmentRecords=100, retention=1000, compactAfter=300, compactInterval=10)
+    fill(store, 0.0, 100)
+    fill(store, 500.0, 100)
+    fill(store, 1200.0, 100)
+    fill(store, 1400.0, 1)
+    starts = [segment.start for segment in store.segments()]
+    #the first segment ended more than retention ago, the second is compacted to 10 s means
+    assert starts == [500.0, 1200.0, 1400.0]
+    compacted = store.query(500.0, 600.0)
+    assert len(compacted) == 10
+    assert np.allclose(compacted['cellVolt'][0], 3.7045)
+    assert len(store.query(1200.0, 1300.0)) == 100
@@ -0,0 +1,42 @@
+import json
+
+from BMSModuleManager import BMSModuleManager
+from BMSSimulator import SimulatedChain
+
+def start(chain, path):
+    bmsmm = BMSModuleManager(chain, topologyFile=str(path))
+    enumerations = []
+    autoAssign = bmsmm.autoAssignModuleAddresses
+    bmsmm.autoAssignModuleAddresses = lambda: enumerations.append(1) or autoAssign()
+    bmsmm.connect()
+    return bmsmm, len(enumerations)
+
+def test_restart_reuses_the_topology(tmp_path):
+    path = tmp_path / 'topology.json'
+    chain = SimulatedChain(4, seed=1)
+    assert start(chain, path)[1] == 1
+    bmsmm, enumerations = start(chain, path)
+    assert enumerations == 0
+    assert [module.moduleAddress for module in bmsmm.modules] == [1, 2, 3, 4]
+
+def test_short_topology_is_not_trusted(tmp_path):
+    path = tmp_path / 'topology.json'
+    chain = SimulatedChain(5, seed=1)
+    start(chain, path)
+    topology = json.loads(path.read_text())
+    topology["modules"] = topology["modules"][:3]
+    topology["count"] = 3
+    path.write_text(json.dumps(topology))
+    bmsmm, enumerations = start(chain, path)
+    assert enumerations == 1
+    assert len(bmsmm.modules) == 5
+    assert json.loads(path.read_text())["count"] == 5
+
+def test_missing_module_re_enumerates(tmp_path):
+    path = tmp_path / 'topology.json'
+    chain = SimulatedChain(4, seed=1)
+    start(chain, path)
+    del chain.modules[3]
+    bmsmm, enumerations = start(chain, path)
+    assert enumerations == 1
+    assert len(bmsmm.modules) == 3
@@ -0,0 +1,68 @@
+import json
+import threading
+import urllib.request
+
+import pytest
+
+from BMSWeb import BMSWebServer, CommandQueue, diffFlat, flatten
+
+@pytest.fixture
+def web():
+    web = BMSWebServer(('127.0.0.1', 0))
+    web.start()
+    yield web
+    web.stop()
+
+def url(web, path):
+    return 'http://127.0.0.1:%d%s' % (web.httpd.server_address[1], path)
+
+def test_api_and_commands(web, makeManager):
+    chain, bmsmm, now = makeManager(3)
+    bmsmm.listeners.append(web.publish)
+    bmsmm.readAllVoltTemp()
+    assert json.load(urllib.request.urlopen(url(web, '/api/modules/2')))['address'] == 2
+    assert len(json.load(urllib.request.urlopen(url(web, '/api/cells')))) == 18
+    #a "command" key in the body is just another argument
+    request = urllib.request.Request(url(web, '/api/commands/balance'), data=b'{"duration": 3, "command": "x"}', method='POST')
+    assert json.load(urllib.request.urlopen(request)) == {'id': 1}
+    assert web.commands.pollCommands() == [(1, 'balance', {'duration': 3, 'command': 'x'})]
+
+def test_removed_values_are_streamed(web, makeManager):
+    chain, bmsmm, now = makeManager(3)
+    bmsmm.listeners.append(web.publish)
+    bmsmm.readAllVoltTemp()
+    events = []
+    def listen():
+        for line in urllib.request.urlopen(url(web, '/api/events'), timeout=5):
+            if line.startswith(b'data:'):
+                events.append(json.loads(line[5:]))
+                if len(events) == 2:
+                    return
+    thread = threading.Thread(target=listen, daemon=True)
+    thread.start()
+    for i in range(100):
+        if events:
+            break
+        thread.join(0.05)
+    #the last module drops off the pack
+    bmsmm.modules.pop()
+    bmsmm.readAllVoltTemp()
+    thread.join(5)
+    assert events[1]['modules.2.address'] is None
+    assert 'modules.2.address' in events[0]
+
+def test_diff_from_an_older_snapshot():
+    old = flatten({'outliers': [{'cell': 1}], 'packVolt': 10.0})
+    new = flatten({'outliers': [], 'packVolt': 10.5})
+    assert diffFlat(old, new) == {'outliers.0.cell': None, 'packVolt': 10.5}
+
+def test_bad_commands_fail_without_stopping_the_loop(makeManager):
+    chain, bmsmm, now = makeManager(spread=0.1)
+    commands = CommandQueue()
+    completed = []
+    commands.completeCommand = lambda id, status: completed.append((id, status))
+    for args in ({'duration': 'abc'}, {'duration': -1}, {'duration': None}, ['abc']):
+        commands.queueCommand('balance', args)
+    commands.queueCommand('clearFaults', {'command': 'sleep'})
+    bmsmm.sweep(60, commands)
+    assert completed == [(1, 'failed'), (2, 'failed'), (3, 'failed'), (4, 'failed'), (5, 'done')]